@@ -0,0 +1,66 @@
+"""
+Import-time benchmark of the payment package controllers
+
+*** every run is a fresh interpreter: django is set up, controllers is
+*** imported and, for the eager run, all three provider modules are imported
+*** the way controllers used to at import time.
+*** wall time and peak RSS are reported as the median of --runs runs.
+
+usage (from the django project root):
+    python -m payment.benchmark_imports --settings project.settings --package payment
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+CHILD = '''
+import importlib, json, os, resource, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', sys.argv[1])
+import django
+django.setup()
+importlib.import_module(sys.argv[2] + '.controllers')
+if sys.argv[3] == 'eager':
+    for name in ('dwolla_provider', 'stripe_provider', 'plaid_provider'):
+        importlib.import_module(sys.argv[2] + '.payment_providers.' + name)
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+'''
+
+
+def run(settings, package, mode, runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD, settings, package, mode],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'seconds': statistics.median(result['seconds'] for result in results),
+        'max_rss_kb': statistics.median(result['max_rss_kb'] for result in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--settings', required=True, help='DJANGO_SETTINGS_MODULE')
+    parser.add_argument('--package', default='payment', help='import path of this package')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    lazy = run(args.settings, args.package, 'lazy', args.runs)
+    eager = run(args.settings, args.package, 'eager', args.runs)
+    for name, result in (('eager', eager), ('lazy', lazy)):
+        print(f"{name:>5}: {result['seconds'] * 1000:8.1f} ms  {result['max_rss_kb'] / 1024:7.1f} MiB")
+    print(f"saved: {(eager['seconds'] - lazy['seconds']) * 1000:8.1f} ms  "
+          f"{(eager['max_rss_kb'] - lazy['max_rss_kb']) / 1024:7.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe bounded LRU cache whose entries expire after ttl seconds
+
+    *** the least recently used entry is evicted once maxsize is reached,
+    *** expired entries are dropped lazily when they are read.
+
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CachedValue:
+    """
+    A single value loaded on first use and kept in memory
+
+    *** invalidate() only bumps the version, so it is cheap enough for a
+    *** post_save/post_delete receiver, the next get() calls loader() again.
+    *** other processes don't get those signals, so the value also expires
+    *** after ttl seconds.
+    *** concurrent get() calls share one load, an invalidate() during a load
+    *** makes the next get() load again.
+
+    """
+
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.value = None
+        self.versions = itertools.count(1)
+        self.version = 0
+        self.loaded_version = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return self.loaded_version != self.version or self.expires_at < time.monotonic()
+
+    def get(self):
+        if self.is_stale():
+            with self.lock:
+                if self.is_stale():
+                    version = self.version
+                    self.value = self.loader()
+                    self.loaded_version = version
+                    self.expires_at = time.monotonic() + self.ttl
+        return self.value
+
+    def invalidate(self, *args, **kwargs):
+        self.version = next(self.versions)
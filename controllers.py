@@ -1,8 +1,14 @@
+import base64
+import calendar
 import logging
 from collections import UserDict
-from django.db.models import Q
+from contextlib import contextmanager
+from decimal import Decimal
+from django.db.models import Count, F, Q
+from django.db.models.signals import post_delete, post_save
 from django.conf import settings
 import datetime
+from django.utils import timezone
 from django.utils.module_loading import import_string
 from datetime import timedelta, datetime
 
@@ -14,10 +20,62 @@ from .models import (
     UserSubscription, Transaction, VerifiedFundingsource, WebhookDetail,
     SubscriptionPlan, PlanCost, PaymentDescriptor, Client, PackageConfig)
 
-from .payment_providers import dwolla_provider, stripe_provider, plaid_provider
+from .provider_registry import lazy_provider_module
+from .cache_utils import CachedValue, TTLCache
+from .identity_map import get_object, identity_map
 
 logger = logging.getLogger(__file__)
 
+# provider sdk modules are imported on first use, see provider_registry
+dwolla_provider = lazy_provider_module('dwolla_provider')
+stripe_provider = lazy_provider_module('stripe_provider')
+plaid_provider = lazy_provider_module('plaid_provider')
+
+# balances are dropped on Installment save/delete, the ttl covers bulk
+# updates and other processes which don't send us that signal
+payable_balance_cache = TTLCache(
+    maxsize=getattr(settings, 'PAYABLE_BALANCE_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'PAYABLE_BALANCE_CACHE_TTL', 60),
+)
+
+# business id -> (True, master account_id) or (False, error) for businesses
+# that are not onboarded yet
+master_account_cache = TTLCache(
+    maxsize=getattr(settings, 'MASTER_ACCOUNT_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'MASTER_ACCOUNT_CACHE_TTL', 15 * 60),
+)
+
+
+def with_auto_now_fields(model_obj, fields):
+    """
+    adds the auto_now fields of the model to update_fields, a partial save
+    skips them otherwise and the row's modified timestamp wouldn't move
+    """
+    fields = list(fields)
+    for field in model_obj._meta.concrete_fields:
+        if getattr(field, 'auto_now', False) and field.name not in fields:
+            fields.append(field.name)
+    return fields
+
+
+def auto_now_values(model):
+    """auto_now fields of a model set to now, for queryset.update() which skips them too"""
+    now = timezone.now()
+    return {
+        field.name: now for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False)
+    }
+
+
+def bulk_update_with_auto_now(model, model_objs, fields):
+    """bulk_update skips auto_now fields as well, so they are set on the objects and written too"""
+    values = auto_now_values(model)
+    for model_obj in model_objs:
+        for name, value in values.items():
+            setattr(model_obj, name, value)
+    fields = list(fields) + [name for name in values if name not in fields]
+    return model.objects.bulk_update(model_objs, fields)
+
 
 class UserSubscriptionController():
     """
@@ -28,6 +86,8 @@ class UserSubscriptionController():
         self.provider = provider
         self.user = user
         self.user_subscription = self.__get_object(user_sub_id)
+        self.dirty_fields = set()
+        self.deferred_depth = 0
 
     def __get_object(self, user_sub_id):
         try:
@@ -39,8 +99,50 @@ class UserSubscriptionController():
             logger.error("Error in UserSubscriptionController.__get_object: " + str(e))
             raise UserSubscription.DoesNotExist
 
-    def save_object(self):
-        self.user_subscription.save()
+    def save_object(self, *fields):
+        """
+        saves the given fields only, or the whole row when none is given,
+        inside deferred_save() the fields are collected and saved on exit
+        """
+        if self.deferred_depth:
+            self.dirty_fields.update(fields or ['__all__'])
+            return
+        if not fields:
+            self.user_subscription.save()
+            return
+        self.user_subscription.save(
+            update_fields=with_auto_now_fields(self.user_subscription, fields))
+
+    @contextmanager
+    def deferred_save(self):
+        """
+        batches setters into a single UPDATE e.g.
+
+            with controller.deferred_save():
+                controller.activate()
+                controller.update_billing_last_date(last)
+                controller.update_billing_next_date(next)
+        """
+        self.deferred_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.deferred_depth -= 1
+            if not self.deferred_depth:
+                self.dirty_fields.clear()
+            raise
+        self.deferred_depth -= 1
+        if not self.deferred_depth:
+            self.flush()
+
+    def flush(self):
+        """saves the fields collected by deferred_save()"""
+        fields, self.dirty_fields = self.dirty_fields, set()
+        if '__all__' in fields:
+            self.user_subscription.save()
+        elif fields:
+            self.user_subscription.save(
+                update_fields=with_auto_now_fields(self.user_subscription, sorted(fields)))
 
     def are_both_funding_sources_added(self):
         """checks if both user and subscriber add thir funding source"""
@@ -71,35 +173,36 @@ class UserSubscriptionController():
     def activate(self):
         """activates a UserSubscription"""
         self.user_subscription.active = True
-        self.save_object()
+        self.save_object('active')
 
     def update_sender_funding_source(self, funding_source):
         self.user_subscription.senderFundingsource = funding_source
-        self.save_object()
+        self.save_object('senderFundingsource')
 
     def update_receiver_funding_source(self, funding_source):
         self.user_subscription.receiverFundingsource = funding_source
-        self.save_object()
+        self.save_object('receiverFundingsource')
 
     def update_billing_start_date(self, datetime_obj):
         self.user_subscription.date_billing_start = datetime_obj
-        self.save_object()
+        self.save_object('date_billing_start')
 
     def update_billing_end_date(self, datetime_obj):
         self.user_subscription.date_billing_end = datetime_obj
-        self.save_object()
+        self.save_object('date_billing_end')
 
     def update_billing_last_date(self, datetime_obj):
         self.user_subscription.date_billing_last = datetime_obj
-        self.save_object()
+        self.save_object('date_billing_last')
 
     def update_billing_next_date(self, datetime_obj):
         self.user_subscription.date_billing_next = datetime_obj
-        self.save_object()
+        self.save_object('date_billing_next')
 
     def update_plan_cost(self, plan_cost_object):
         self.user_subscription.subscription = plan_cost_object
-        self.save_object()
+        self.save_object('subscription')
+        payable_balance_cache.delete(self.user_subscription.id)
 
     def list_installments(self):
         """return list of all installments of UserSubscription obj"""
@@ -114,9 +217,58 @@ class UserSubscriptionController():
 
     def calculate_payable_balance(self):
         """returns remaining balance that should user pay"""
-        installments = self.user_subscription.subscription_installment.filter(status='empty').count()
-        cost = self.user_subscription.subscription.cost
-        return int(installments) * float(cost)
+        balances = self.calculate_payable_balances([self.user_subscription])
+        return float(balances.get(self.user_subscription.id, 0))
+
+    @classmethod
+    def calculate_payable_balances(cls, user_subscriptions, use_cache=True):
+        """
+        returns a dict of user subscription id -> remaining balance as Decimal
+
+        *** empty installments are counted per subscription in one grouped
+        *** query, balances of subscriptions whose installments didn't change
+        *** since the last call come from payable_balance_cache.
+        """
+        ids = [getattr(user_sub, 'id', user_sub) for user_sub in user_subscriptions]
+        balances = dict()
+        if use_cache:
+            for user_sub_id in ids:
+                balance = payable_balance_cache.get(user_sub_id)
+                if balance is not None:
+                    balances[user_sub_id] = balance
+        missing = [user_sub_id for user_sub_id in ids if user_sub_id not in balances]
+        if missing:
+            rows = UserSubscription.objects.filter(id__in=missing).annotate(
+                empty_installments=Count(
+                    'subscription_installment', filter=Q(subscription_installment__status='empty'))
+            ).values_list('id', 'empty_installments', 'subscription__cost')
+            for user_sub_id, empty_installments, cost in rows:
+                balance = empty_installments * Decimal(str(cost or 0))
+                payable_balance_cache.set(user_sub_id, balance)
+                balances[user_sub_id] = balance
+        return balances
+
+    @classmethod
+    def payable_balance_summary(cls, user_subscriptions):
+        """returns total payable balance of user subscriptions and balance of each one"""
+        balances = cls.calculate_payable_balances(user_subscriptions)
+        return {
+            'total': sum(balances.values(), Decimal('0')),
+            'subscriptions': balances,
+        }
+
+    @classmethod
+    def invalidate_payable_balance(cls, sender=None, instance=None, **kwargs):
+        """drops the cached balance of the subscription of a changed installment"""
+        if instance is not None and instance.subscription_id is not None:
+            payable_balance_cache.delete(instance.subscription_id)
+
+    @classmethod
+    def invalidate_plan_cost_balances(cls, sender=None, instance=None, **kwargs):
+        """drops the cached balances of every subscription of a changed PlanCost"""
+        for user_sub_id in UserSubscription.objects.filter(
+                subscription=instance).values_list('id', flat=True):
+            payable_balance_cache.delete(user_sub_id)
 
     def has_previous_transaction(self):
         """checks if therse is a pending transaction for this UserSubscription obj"""
@@ -134,8 +286,7 @@ class UserSubscriptionController():
 
     def create_installments(self):
         terms = int(self.user_subscription.term)
-        for i in range(terms):
-            Installment.objects.create(subscription=self.user_subscription)
+        InstallmentController.bulk_create(self.user_subscription, [None] * terms)
 
     @classmethod
     def get_user_subscription_by_provider_id(cls, id):
@@ -164,26 +315,38 @@ class UserSubscriptionController():
         return queryset1 | queryset2
 
     @classmethod
-    def list_installments_user_sub_queryset(cls, all_user_sub):
-        """return list of all installment of a UserSubscription queryset"""
-        list_installment = Installment.objects.none()
-        for sub in all_user_sub:
-            sub_installment = sub.subscription_installment.all()
-            list_installment = list_installment | sub_installment
+    def list_installments_user_sub_queryset(cls, all_user_sub, with_subscription=False,
+                                            page=None, page_size=None):
+        """
+        return list of all installment of a UserSubscription queryset
+
+        *** one query whatever the number of subscriptions, a queryset passed
+        *** as all_user_sub becomes a subquery.
+        *** with_subscription joins the UserSubscription of every installment.
+        *** with page_size the installments are ordered by id and `page`
+        *** (starting at 1) of them is returned.
+        """
+        list_installment = Installment.objects.filter(subscription__in=all_user_sub)
+        if with_subscription:
+            list_installment = list_installment.select_related('subscription')
+        if page_size:
+            offset = (max(int(page or 1), 1) - 1) * page_size
+            list_installment = list_installment.order_by('id')[offset:offset + page_size]
         return list_installment
 
     @classmethod
+    @identity_map()
     def create(cls, *args, **kwargs):
         """creates a UserSubscription obj"""
         provider = PackageConfigController.get_provider()
         try:
             subscriber_user = kwargs.get('subscriber')
             try:
-                sub_client = Client.objects.get(
-                    user=subscriber_user, client_type='no_account')
+                sub_client = get_object(
+                    Client, user=subscriber_user, client_type='no_account')
             except:
-                sub_client = Client.objects.get(
-                    customer=subscriber_user, client_type='no_account')
+                sub_client = get_object(
+                    Client, customer=subscriber_user, client_type='no_account')
 
             subscriber_billing = CustomerController().get_default_billing(
                 client=sub_client
@@ -194,8 +357,8 @@ class UserSubscriptionController():
 
         try:
             receiver_user = kwargs.get('user')
-            rec_client = Client.objects.get(
-                user=receiver_user, client_type='has_account', business=sub_client.business)
+            rec_client = get_object(
+                Client, user=receiver_user, client_type='has_account', business=sub_client.business)
             receiver_user_billing = CustomerController().get_default_billing(
                 client=rec_client
             )
@@ -243,11 +406,8 @@ class UserSubscriptionController():
 
         # create installment objects
         plan_cost = subscription_object.subscription
-        for i in range(plan_cost.recurrence_period):
-            Installment.objects.create(
-                due_date=datetime.now(),
-                subscription=subscription_object
-            )
+        InstallmentController.bulk_create(
+            subscription_object, [datetime.now()] * plan_cost.recurrence_period)
 
         return subscription_object
 
@@ -310,7 +470,7 @@ class UserSubscriptionController():
             except Exception as e:
                 logger.error(f"UserSubscriptionController.update_subscription \ stripe_call error: {str(e)}")
         try:
-            plan_cost_obj = PlanCost.objects.get(id=kwargs['product_id'])
+            plan_cost_obj = get_object(PlanCost, id=kwargs['product_id'])
             plan_cost_obj.recurrence_period = interval_count
             plan_cost_obj.recurrence_unit = recurring
             plan_cost_obj.cost = price
@@ -377,6 +537,17 @@ class UserSubscriptionController():
             return resp
 
 
+post_save.connect(
+    UserSubscriptionController.invalidate_payable_balance, sender=Installment,
+    dispatch_uid='payable_balance_cache_save')
+post_delete.connect(
+    UserSubscriptionController.invalidate_payable_balance, sender=Installment,
+    dispatch_uid='payable_balance_cache_delete')
+post_save.connect(
+    UserSubscriptionController.invalidate_plan_cost_balances, sender=PlanCost,
+    dispatch_uid='payable_balance_cache_plan_cost')
+
+
 class BaseInstallmentClass:
     """Base class for Installment model"""
 
@@ -415,19 +586,47 @@ class InstallmentController(BaseInstallmentClass):
         except:
             raise Installment.DoesNotExist
 
-    def save_object(self):
-        self.installment_object.save()
+    def save_object(self, *fields):
+        """saves the given fields only, or the whole row when none is given"""
+        if not fields:
+            self.installment_object.save()
+            return
+        self.installment_object.save(
+            update_fields=with_auto_now_fields(self.installment_object, fields))
+
+    def increment(self, field):
+        """adds one to a counter in the database so concurrent workers don't lose increments"""
+        Installment.objects.filter(id=self.installment_object.id).update(
+            **{field: F(field) + 1}, **auto_now_values(Installment))
+        self.installment_object.refresh_from_db(fields=[field])
 
     def update_status(self, status, status_change_date):
         """updates status and status_change_date of installment"""
         self.installment_object.status = status
         self.installment_object.status_change_date = status_change_date
-        self.save_object()
+        self.save_object('status', 'status_change_date')
+
+    @classmethod
+    def bulk_update_status(cls, installment_ids, status, status_change_date, from_status=None):
+        """
+        updates status of many installments with a single UPDATE, e.g. for
+        the dunning run, only installments in from_status are moved when
+        it is given. returns the number of updated installments
+        """
+        installments = Installment.objects.filter(id__in=installment_ids)
+        if from_status is not None:
+            installments = installments.filter(status=from_status)
+        subscription_ids = set(installments.values_list('subscription_id', flat=True))
+        updated = installments.update(
+            status=status, status_change_date=status_change_date, **auto_now_values(Installment))
+        # update() sends no post_save, drop the cached balances ourselves
+        for subscription_id in subscription_ids:
+            payable_balance_cache.delete(subscription_id)
+        return updated
 
     def increase_retries(self):
         """increase number of payment retries for a installment"""
-        self.installment_object.retries += 1
-        self.save_object()
+        self.increment('retries')
 
     def set_user_subscription(self, user_sub_id):
         """sets user subscription for installment"""
@@ -436,18 +635,17 @@ class InstallmentController(BaseInstallmentClass):
         except:
             raise UserSubscription.DoesNotExist
         self.installment_object.subscription = user_sub_obj
-        self.save_object()
+        self.save_object('subscription')
 
     def increase_notifications_sent_times(self):
         """increase number of how many times notification is sent for this installment"""
-        self.installment_object.notifications_sent += 1
-        self.save_object()
+        self.increment('notifications_sent')
 
     def update_notifications_date(self, notification_sent_date):
         """updates last time a notification sent for this installment"""
         try:
             self.installment_object.notifications_sent_date = notification_sent_date
-            self.save_object()
+            self.save_object('notifications_sent_date')
         except:
             raise ValidationError('Not valid data provided.')
 
@@ -470,64 +668,167 @@ class InstallmentController(BaseInstallmentClass):
         return Installment.objects.filter(subscription=user_subscription).order_by('id')
 
     @classmethod
-    def create_subscription_installments(cls, user_subscription, interval, interval_count):
+    def bulk_create(cls, user_subscription, due_dates):
+        """
+        creates one installment per due date with a single batched insert,
+        a None due date keeps the model default
+        """
+        installments = []
+        for due_date in due_dates:
+            installment = Installment(subscription=user_subscription)
+            if due_date is not None:
+                installment.due_date = due_date
+            installments.append(installment)
+        installments = Installment.objects.bulk_create(installments, batch_size=500)
+        # bulk_create sends no post_save, drop the cached balance ourselves
+        payable_balance_cache.delete(user_subscription.id)
+        return installments
+
+    @staticmethod
+    def add_months(date, months):
+        """
+        steps a date on the calendar, a day missing in the target month is
+        clamped to its last day e.g. jan 31 + 1 month -> feb 28
+        """
+        month_index = date.month - 1 + months
+        year = date.year + month_index // 12
+        month = month_index % 12 + 1
+        day = min(date.day, calendar.monthrange(year, month)[1])
+        return date.replace(year=year, month=month, day=day)
+
+    @classmethod
+    def due_dates(cls, start_date, interval, interval_count):
+        """returns interval_count due dates starting at start_date, one interval apart"""
         if interval not in ['day', 'month', 'year']:
             raise ValueError("Invalid interval. Choose from 'day', 'month', or 'year'.")
 
-        due_date = datetime.now()
-        time_delta = None
-
+        # every date is computed from start_date so month end clamping doesn't drift
         if interval == 'day':
-            time_delta = timedelta(days=1)
+            return [start_date + timedelta(days=i) for i in range(interval_count)]
         elif interval == 'month':
-            time_delta = timedelta(days=30)
-        elif interval == 'year':
-            time_delta = timedelta(days=365)
-
-        for _ in range(interval_count):
-            Installment.objects.create(
-                due_date=due_date,
-                subscription=user_subscription
-            )
-            due_date += time_delta
+            return [cls.add_months(start_date, i) for i in range(interval_count)]
+        return [cls.add_months(start_date, 12 * i) for i in range(interval_count)]
+
+    @classmethod
+    def create_subscription_installments(cls, user_subscription, interval, interval_count):
+        due_dates = cls.due_dates(datetime.now(), interval, interval_count)
+        return cls.bulk_create(user_subscription, due_dates)
 
 
 class FeesController():
-    """This class holds actions required to interact with FeeProfile and Feelogs models"""
+    """
+    This class holds actions required to interact with FeeProfile and Feelogs models
+
+    *** the latest enabled fee of every fee_type is kept in an in-memory fee
+    *** table, loaded with one query and dropped whenever a FeeProfile is
+    *** saved or deleted (see the receivers below) or after FEE_TABLE_CACHE_TTL
+    *** seconds for changes made by other processes.
+    """
+    @staticmethod
+    def load_fee_table():
+        fee_table = dict()
+        for fee_type, fee in FeeProfile.objects.filter(enabled=True). \
+                order_by('-updated').values_list('fee_type', 'fee'):
+            fee_table.setdefault(fee_type, fee)
+        return fee_table
+
+    fee_table_cache = CachedValue(
+        lambda: FeesController.load_fee_table(),
+        ttl=getattr(settings, 'FEE_TABLE_CACHE_TTL', 60))
+
+    @classmethod
+    def get_fee_table(cls):
+        """returns a dict of fee_type -> fee of the latest enabled FeeProfiles"""
+        return cls.fee_table_cache.get()
+
+    @classmethod
+    def invalidate_fee_table(cls, *args, **kwargs):
+        cls.fee_table_cache.invalidate()
 
     def get_fee_by_name(self, names_list):
-        """returns a list of FeeProfile objs based on its name"""
+        """returns a list of fees of the latest enabled FeeProfile of each name"""
+        fee_table = self.get_fee_table()
         try:
-            fees_list = []
-            for name in names_list:
-                fee = FeeProfile.objects.filter(enabled=True). \
-                    order_by('-updated').get(fee_type=name)
-                fees_list.append(fee.fee)
-            return fees_list
-        except:
+            return [fee_table[name] for name in names_list]
+        except KeyError:
             raise ValidationError("No record found for loan_setup_fee")
 
-    def save_fee_logs_by_transfer_id(self, provider, transfer_id):
-        """get list of fees are taken from transaction"""
+    def get_fee_transactions(self, provider, transfer_id):
+        """returns the fee transactions taken from a transfer, empty if there is none"""
         fee_info = TransferController(provider).get_fee_of_transaction(transfer_id)
-        total_fees = int(fee_info['total'])
-        if total_fees != 0:
-            for transaction in fee_info['transactions']:
-                # Do the saving.
-                link = transaction['_links']['self']['href']
-                source = transaction['_links']['source']['href']
-                status = transaction['status']
-                amount = transaction['amount']['value']
-                created_from_transfer = transaction['_links']['created-from-transfer']['href']
-                transaction_object = TransferController.get_transfer_by_url(created_from_transfer)
-                customer_obj = BillingInformation.objects.get(customer_url=source)
-                FeeLogs.objects.create(
+        if int(fee_info['total']) == 0:
+            return []
+        return fee_info['transactions']
+
+    @staticmethod
+    def transfer_id_from_url(transfer_url):
+        """provider transfer urls end with the transfer id"""
+        return transfer_url.rstrip('/').rsplit('/', 1)[-1]
+
+    def save_fee_logs_by_transfer_id(self, provider, transfer_id):
+        """
+        get list of fees are taken from transaction
+
+        *** referenced transfers and billing objects are loaded with one query
+        *** each, fee logs are inserted with bulk_create and the ones already
+        *** saved by an earlier delivery of the same event are bulk updated.
+        """
+        fee_transactions = self.get_fee_transactions(provider, transfer_id)
+        if not fee_transactions:
+            return
+
+        transfer_ids = {
+            self.transfer_id_from_url(transaction['_links']['created-from-transfer']['href'])
+            for transaction in fee_transactions
+        }
+        sources = {transaction['_links']['source']['href'] for transaction in fee_transactions}
+        links = [transaction['_links']['self']['href'] for transaction in fee_transactions]
+        transfers = {
+            transfer.transfer_id: transfer
+            for transfer in Transaction.objects.filter(transfer_id__in=transfer_ids)
+        }
+        customers = {
+            customer.customer_url: customer
+            for customer in BillingInformation.objects.filter(customer_url__in=sources)
+        }
+        fee_logs = {
+            fee_log.transfer_url: fee_log
+            for fee_log in FeeLogs.objects.filter(transfer_url__in=links)
+        }
+
+        to_create, to_update = [], []
+        for transaction in fee_transactions:
+            link = transaction['_links']['self']['href']
+            source = transaction['_links']['source']['href']
+            status = transaction['status']
+            amount = transaction['amount']['value']
+            created_from_transfer = self.transfer_id_from_url(
+                transaction['_links']['created-from-transfer']['href'])
+            if created_from_transfer not in transfers:
+                raise Transaction.DoesNotExist(f'transfer {created_from_transfer} not found')
+            if source not in customers:
+                raise BillingInformation.DoesNotExist(f'customer {source} not found')
+
+            fee_log = fee_logs.get(link)
+            if fee_log is None:
+                fee_log = FeeLogs(
                     amount=amount,
                     status=status,
                     transfer_url=link,
-                    transaction=transaction_object,
-                    customer=customer_obj
+                    transaction=transfers[created_from_transfer],
+                    customer=customers[source]
                 )
+                fee_logs[link] = fee_log
+                to_create.append(fee_log)
+            elif fee_log.status != status or str(fee_log.amount) != str(amount):
+                fee_log.status = status
+                fee_log.amount = amount
+                to_update.append(fee_log)
+
+        if to_create:
+            FeeLogs.objects.bulk_create(to_create)
+        if to_update:
+            bulk_update_with_auto_now(FeeLogs, to_update, ['status', 'amount'])
 
     def add_to_fees(self, provider, fees, customer_id, amount):
         """creates fee obj to add to a transaction"""
@@ -537,18 +838,20 @@ class FeesController():
         return fees
 
     def update_fee_logs_status_by_transfer_id(self, provider, transfer_id):
-        """updates feelogs status"""
-        fee_info = TransferController().get_fee_of_transaction(provider, transfer_id)
-        total_fees = int(fee_info['total'])
-        if total_fees != 0:
-            for transaction in fee_info['transactions']:
-                fee_transfer_url = transaction['_links']['self']['href']
-                try:
-                    fee_log = FeeLogs.objects.get(transfer_url=fee_transfer_url)
-                    fee_log.status = transaction['status']
-                    fee_log.save()
-                except:
-                    pass
+        """updates feelogs status, only the changed ones are written with one bulk_update"""
+        statuses = {
+            transaction['_links']['self']['href']: transaction['status']
+            for transaction in self.get_fee_transactions(provider, transfer_id)
+        }
+        if not statuses:
+            return
+        changed = []
+        for fee_log in FeeLogs.objects.filter(transfer_url__in=list(statuses)):
+            if fee_log.status != statuses[fee_log.transfer_url]:
+                fee_log.status = statuses[fee_log.transfer_url]
+                changed.append(fee_log)
+        if changed:
+            bulk_update_with_auto_now(FeeLogs, changed, ['status'])
 
     def create_fee_profile(self, **kwargs):
         """create FeeProfile obj"""
@@ -559,6 +862,7 @@ class FeesController():
             enabled=kwargs.get('enabled'),
             fee_type=kwargs.get('fee_type'),
         )
+        self.invalidate_fee_table()
         return fee_obj
 
     def all_fee_profile_list(self):
@@ -566,6 +870,14 @@ class FeesController():
         return FeeProfile.objects.all()
 
 
+post_save.connect(
+    FeesController.invalidate_fee_table, sender=FeeProfile,
+    dispatch_uid='fee_table_cache_save')
+post_delete.connect(
+    FeesController.invalidate_fee_table, sender=FeeProfile,
+    dispatch_uid='fee_table_cache_delete')
+
+
 class GetPaymentInitiationTokenContorller:
     """returns the Payment Provider token that is needed in frontend to integrate with backend"""
 
@@ -591,7 +903,7 @@ class ClientController:
     @classmethod
     def get_user_client(self, user):
         try:
-            client = Client.objects.get(user=user)
+            client = get_object(Client, user=user)
         except Exception as e:
             raise Exception({"error": f"error in getting the user client: {str(e)}"})
         return client
@@ -599,7 +911,7 @@ class ClientController:
     @classmethod
     def get_user_business_client(self, user, business):
         try:
-            client = Client.objects.get(user=user, business=business)
+            client = get_object(Client, user=user, business=business)
         except Exception as e:
 
             raise Exception({"error": f"error in getting the user client: {str(e)}"})
@@ -696,35 +1008,58 @@ class ClientController:
     @classmethod
     def get_customer_master_account(self, user):
         client = self.get_user_client(user)
-        try:
-            master_account = BillingInformation.objects.get(
-                client__business=client.business,
-                client__client_type='has_account',
-                provider='stripe'
-            ).account_id
-        except Exception as e:
-
-            raise ValidationError({"error": f"getting master account {str(e)}"})
-        return master_account
+        return self.get_business_master_account(client.business_id)
 
     @classmethod
     def get_customer_master_account_by_client(self, client):
         # client = self.get_user_client(user)
-        try:
-            master_account = BillingInformation.objects.get(
-                client__business=client.business,
-                client__client_type='has_account',
-                provider='stripe'
-            ).account_id
-        except Exception as e:
+        return self.get_business_master_account(client.business_id)
+
+    @classmethod
+    def get_business_master_account(cls, business_id):
+        """
+        returns the stripe account_id of the master account of a business
+
+        *** cached per business in master_account_cache, businesses that are not
+        *** onboarded are cached too, for MASTER_ACCOUNT_NEGATIVE_CACHE_TTL seconds.
+        *** entries are dropped when a Client or BillingInformation of the
+        *** business is saved or deleted.
+        """
+        cached = master_account_cache.get(business_id)
+        if cached is None:
+            try:
+                cached = (True, BillingInformation.objects.get(
+                    client__business_id=business_id,
+                    client__client_type='has_account',
+                    provider='stripe'
+                ).account_id)
+                master_account_cache.set(business_id, cached)
+            except BillingInformation.DoesNotExist as e:
+                cached = (False, str(e))
+                master_account_cache.set(business_id, cached, ttl=getattr(
+                    settings, 'MASTER_ACCOUNT_NEGATIVE_CACHE_TTL', 30))
+            except Exception as e:
+
+                raise ValidationError({"error": f"getting master account {str(e)}"})
+        found, value = cached
+        if not found:
+            raise ValidationError({"error": f"getting master account {value}"})
+        return value
 
-            raise ValidationError({"error": f"getting master account {str(e)}"})
-        return master_account
+    @classmethod
+    def invalidate_master_account(cls, sender=None, instance=None, **kwargs):
+        if isinstance(instance, Client):
+            business_id = instance.business_id
+        else:
+            business_id = Client.objects.filter(
+                id=instance.client_id).values_list('business_id', flat=True).first()
+        if business_id is not None:
+            master_account_cache.delete(business_id)
 
     @classmethod
     def get_client_by_customer_obj(cls, customer_obj):
         try:
-            client = Client.objects.get(customer=customer_obj)
+            client = get_object(Client, customer=customer_obj)
         except Exception as e:
             logger.exception(f'**Payment Package** exception in '
                              f'get_client_by_customer_obj: {str(e)}')
@@ -734,14 +1069,14 @@ class ClientController:
     @classmethod
     def get_billing_by_client(cls, business, client_type):
         try:
-            client = Client.objects.get(business=business, client_type=client_type)
+            client = get_object(Client, business=business, client_type=client_type)
         except Exception as e:
             print(e)
             raise ValidationError(
                 {'payment_package_error':
                      ['1.office needs to complete the payment package onboarding']})
         try:
-            billing = BillingInformation.objects.get(client=client)
+            billing = get_object(BillingInformation, client=client)
         except Exception as e:
             raise ValidationError(
                 {'payment_package_error':
@@ -749,6 +1084,15 @@ class ClientController:
         return client, billing
 
 
+for model in (Client, BillingInformation):
+    post_save.connect(
+        ClientController.invalidate_master_account, sender=model,
+        dispatch_uid=f'master_account_cache_save_{model.__name__}')
+    post_delete.connect(
+        ClientController.invalidate_master_account, sender=model,
+        dispatch_uid=f'master_account_cache_delete_{model.__name__}')
+
+
 class CustomerController:
     """
     This class holds actions required to interact with BillingInfromation models
@@ -992,17 +1336,16 @@ class CustomerController:
     def get_client_billing(self, client, provider=None):
         try:
             if provider:
-                billing_obj = BillingInformation.objects.get(
-                    client=client, provider=provider)
+                billing_obj = get_object(BillingInformation, client=client, provider=provider)
             else:
-                billing_obj = BillingInformation.objects.get(client=client)
+                billing_obj = get_object(BillingInformation, client=client)
         except Exception as e:
             raise Exception({"error": f"error in getting the client's billing: {str(e)}"})
         return billing_obj
 
     def get_default_billing(self, client):
-        return BillingInformation.objects.get(
-            provider=self.provider, client=client, is_default=True)
+        return get_object(
+            BillingInformation, provider=self.provider, client=client, is_default=True)
 
 
 class WebhookController:
@@ -1072,6 +1415,9 @@ class FundingSourceController:
     and make api call with Payment provider to create/update/get/delete funding source
     """
 
+    # fields refreshed on existing rows, bank_name is only set on creation
+    reconciled_funding_fields = ['fundingsource_name', 'type_of_source', 'deleted', 'pending_microdeposit']
+
     def __init__(self):
         pass
 
@@ -1110,7 +1456,7 @@ class FundingSourceController:
     def get_verified_funding_source(self, billing_obj, funding_source_id):
         """return a VerifiedFundingSource obj"""
         try:
-            return VerifiedFundingsource.objects.filter(profile=billing_obj).get(id=funding_source_id)
+            return get_object(VerifiedFundingsource, profile=billing_obj, id=funding_source_id)
         except:
             return None
 
@@ -1301,8 +1647,7 @@ class FundingSourceController:
                 stripe_account=master_account
             )
 
-        for funding_data in funding_sources_list:
-            self.check_if_funding_exists(billing_obj, funding_data)
+        self.reconcile_funding_sources(billing_obj, funding_sources_list)
 
         return self.list_verified_funding_source(billing_obj)
 
@@ -1350,6 +1695,10 @@ class FundingSourceController:
 
     def check_if_funding_exists(self, customer_obj, funding_data):
         """it checks if all funding sources are saved in data base else it will create it"""
+        self.reconcile_funding_sources(customer_obj, [funding_data])
+
+    def normalize_funding_data(self, customer_obj, funding_data):
+        """maps a dwolla/stripe funding source payload to VerifiedFundingsource fields"""
         provider = customer_obj.provider
         if provider in ['dwolla', 'dwolla+plaid']:
             funding_id = funding_data['id']
@@ -1382,25 +1731,55 @@ class FundingSourceController:
             deleted = False
             pending_microdeposit = False
 
-        funding_obj = VerifiedFundingsource.objects.filter(funding_id=funding_id)
-        if not funding_obj:
-            self.create_verified_funding_source(
-                customer=customer_obj,
-                fundingsource_name=funding_name,
-                funding_id=funding_id,
-                bank_name=bank_name,
-                type_of_source=type_of_source,
-                deleted=deleted,
-                pending_microdeposit=pending_microdeposit
-            )
-        else:
-            self.update_verified_funding_source(
-                funding_obj.last(),
-                fundingsource_name=funding_name,
-                type_of_source=type_of_source,
-                deleted=deleted,
-                pending_microdeposit=pending_microdeposit
-            )
+        return {
+            'funding_id': funding_id,
+            'fundingsource_name': funding_name,
+            'bank_name': bank_name,
+            'type_of_source': type_of_source,
+            'deleted': deleted,
+            'pending_microdeposit': pending_microdeposit,
+        }
+
+    def reconcile_funding_sources(self, customer_obj, funding_sources_list):
+        """
+        saves the funding sources of a provider payload in bulk
+
+        *** existing rows are loaded with one query, missing ones are added
+        *** with bulk_create and existing ones only go to bulk_update when
+        *** one of their fields actually changed.
+        """
+        funding_sources = dict()
+        for funding_data in funding_sources_list:
+            fields = self.normalize_funding_data(customer_obj, funding_data)
+            funding_sources[fields.pop('funding_id')] = fields
+
+        existing = dict()
+        # ordered by pk so the last row wins like the old filter().last()
+        for funding_obj in VerifiedFundingsource.objects.filter(
+                funding_id__in=list(funding_sources)).order_by('pk'):
+            existing[funding_obj.funding_id] = funding_obj
+
+        to_create, to_update = [], []
+        for funding_id, fields in funding_sources.items():
+            funding_obj = existing.get(funding_id)
+            if funding_obj is None:
+                to_create.append(VerifiedFundingsource(
+                    profile=customer_obj, funding_id=funding_id, **fields))
+                continue
+            changed = False
+            for field in self.reconciled_funding_fields:
+                if getattr(funding_obj, field) != fields[field]:
+                    setattr(funding_obj, field, fields[field])
+                    changed = True
+            if changed:
+                to_update.append(funding_obj)
+
+        if to_create:
+            VerifiedFundingsource.objects.bulk_create(to_create)
+        if to_update:
+            bulk_update_with_auto_now(
+                VerifiedFundingsource, to_update, self.reconciled_funding_fields)
+        return to_create, to_update
 
     def is_valid_funding_source(self, funding_source):
         """check if funding source is valid to initiate a payment/transfer"""
@@ -1552,6 +1931,42 @@ class TransferController:
 
         return transactions_queryset
 
+    def transaction_page(self, user, cursor=None, page_size=50, **kwargs):
+        """
+        keyset paginated transaction_list, returns (transactions, next_cursor)
+
+        *** transactions are ordered newest first by id and the cursor is the
+        *** opaque encoded id of the last one, the next page is read with
+        *** `id < last id` instead of an OFFSET so every page costs the same.
+        *** next_cursor is None on the last page. the filters are served by
+        *** (source_user, -id), (destination_user, -id) and the same with
+        *** status between them as Transaction Meta.indexes.
+        """
+        page_size = max(1, min(int(page_size), 200))
+        transactions_queryset = self.transaction_list(user, **kwargs)
+        if cursor:
+            transactions_queryset = transactions_queryset.filter(
+                id__lt=self.decode_transaction_cursor(cursor))
+        transactions = list(transactions_queryset.order_by('-id')[:page_size + 1])
+
+        next_cursor = None
+        if len(transactions) > page_size:
+            transactions = transactions[:page_size]
+            next_cursor = self.encode_transaction_cursor(transactions[-1].id)
+        return transactions, next_cursor
+
+    @staticmethod
+    def encode_transaction_cursor(transaction_id):
+        return base64.urlsafe_b64encode(str(transaction_id).encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_transaction_cursor(cursor):
+        try:
+            padding = '=' * (-len(cursor) % 4)
+            return int(base64.urlsafe_b64decode(cursor + padding).decode())
+        except Exception:
+            raise ValidationError('Not valid cursor provided.')
+
     def initiate_transfer(self, **kwargs):
         """
         makes an api call to initiate a transfer
@@ -1696,9 +2111,31 @@ class PlanCostController:
 
 
 class PackageConfigController:
+    """
+    The active PackageConfig is loaded once per process and kept in memory
+
+    *** saving or deleting a PackageConfig invalidates config_cache through
+    *** the post_save/post_delete receivers below, which drops the cached row.
+    *** other processes don't get the signal, so the cached row also expires
+    *** after PACKAGE_CONFIG_CACHE_TTL seconds.
+
+    """
+    config_cache = CachedValue(
+        lambda: PackageConfig.objects.filter(is_active=True).first(),
+        ttl=getattr(settings, 'PACKAGE_CONFIG_CACHE_TTL', 60))
+
+    @classmethod
+    def get_config(cls):
+        """returns the active PackageConfig or None"""
+        return cls.config_cache.get()
+
+    @classmethod
+    def invalidate(cls, *args, **kwargs):
+        cls.config_cache.invalidate()
+
     @classmethod
     def get_provider(self, option=None):
-        config = PackageConfig.objects.filter(is_active=True).first()
+        config = self.get_config()
         if config:
             if not option:
                 return config.provider
@@ -1720,8 +2157,17 @@ class PackageConfigController:
     #         return 'dwolla'
 
 
+post_save.connect(
+    PackageConfigController.invalidate, sender=PackageConfig,
+    dispatch_uid='package_config_cache_save')
+post_delete.connect(
+    PackageConfigController.invalidate, sender=PackageConfig,
+    dispatch_uid='package_config_cache_delete')
+
+
 class SubscriptionScheduleController:
     @classmethod
+    @identity_map()
     def create_sub_sch(cls, subscriber, subscription_owner, plan_cost, start_date,
                        iterations, application_fee_percent, description, interval_unit):
 
@@ -1729,12 +2175,13 @@ class SubscriptionScheduleController:
 
         # Get Customer
         customer_client = ClientController.get_client_by_customer_obj(subscriber)
-        customer_billing = BillingInformation.objects.get(client=customer_client)
+        customer_billing = get_object(BillingInformation, client=customer_client)
         customer_id = customer_billing.customer_id
 
         # Master Account
-        rec_client = Client.objects.get(
-            user=subscription_owner, client_type='has_account', business=customer_client.business)
+        rec_client = get_object(
+            Client, user=subscription_owner, client_type='has_account',
+            business=customer_client.business)
         subscription_owner_billing = CustomerController().get_default_billing(
             client=rec_client
         )
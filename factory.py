@@ -1,5 +1,12 @@
+import threading
+import time
 from abc import ABC, abstractmethod
+from contextvars import ContextVar
 
+from abstract_classes_refactor import AbstractSinglePayment
+from helcim_breaker import HelcimCircuitOpenError
+from helcim_pipeline import AuthHeadersStage, get_pipeline
+from helcim_transport import HELCIM_API_URL, get_transport
 from helcim_provide_refactor import HelcimSinglePaymentStrategy, HelcimRecurringPaymentStrategy, \
     HelcimSingleTransferStrategy, HelcimRecurringTransferStrategy
 from helcim_provider_refactor import HelcimCustomerClient, HelcimMerchantClient
@@ -38,6 +45,32 @@ class FinancialProviderFactory(ABC):
 
 
 class HelcimFactory(FinancialProviderFactory):
+    @staticmethod
+    def is_unavailable_error(error):
+        """
+        True only if the breaker refused the first attempt of the call, once
+        an attempt went out the payment may have reached Helcim
+        """
+        return isinstance(error, HelcimCircuitOpenError) and not error.request_sent
+
+    @staticmethod
+    def is_failed_result(result):
+        """
+        True for results that came back without an exception but still failed:
+        a throttled or 5xx response handed back after retries, or an `errors` /
+        {'status': 'ERROR'} payload
+        """
+        status_code = getattr(result, 'status_code', None)
+        if status_code is not None:
+            return status_code == 429 or status_code >= 500
+        return isinstance(result, dict) and \
+            (result.get('status', None) == 'ERROR' or bool(result.get('errors', None)))
+
+    def is_available(self):
+        """False while the circuit breaker of Helcim purchases is open"""
+        breaker = get_transport().breakers.get('POST', HELCIM_API_URL + '/v2/payment/purchase')
+        return not breaker.is_open()
+
     def create_customer_client(self, *args, **kwargs):
         return HelcimCustomerClient()
 
@@ -55,3 +88,271 @@ class HelcimFactory(FinancialProviderFactory):
 
     def create_recurring_transfer_strategy(self, *args, **kwargs):
         return HelcimRecurringTransferStrategy()
+
+    def warm_up(self, account_id):
+        """builds the auth headers of an account before its first call"""
+        auth_headers = get_pipeline().get_stage(AuthHeadersStage)
+        if auth_headers is not None:
+            auth_headers.static_headers(account_id, True)
+            auth_headers.static_headers(account_id, False)
+
+
+class FinancialProviderRegistry:
+    """
+    Maps provider names to their FinancialProviderFactory
+
+    *** clients and strategies are created once per (provider, kind, account)
+    *** and reused, they all share the process wide pooled transport so a
+    *** cached strategy keeps warm connections and precomputed headers.
+    *** kind is the part after create_ of a factory method, e.g.
+    *** registry.get('helcim', 'single_payment_strategy', account_id).
+
+    """
+
+    def __init__(self):
+        self.factories = dict()
+        self.instances = dict()
+        self.lock = threading.Lock()
+
+    def register(self, provider, factory):
+        """factory is a FinancialProviderFactory class or instance"""
+        if isinstance(factory, type):
+            factory = factory()
+        with self.lock:
+            self.factories[provider] = factory
+            self.instances = {
+                key: instance for key, instance in self.instances.items() if key[0] != provider
+            }
+
+    def factory(self, provider):
+        try:
+            return self.factories[provider]
+        except KeyError:
+            raise ValueError(f'No financial provider factory registered for {provider}')
+
+    def get(self, provider, kind, account_id=None):
+        key = (provider, kind, account_id)
+        instance = self.instances.get(key)
+        if instance is None:
+            with self.lock:
+                instance = self.instances.get(key)
+                if instance is None:
+                    factory = self.factory(provider)
+                    instance = getattr(factory, f'create_{kind}')(account_id=account_id)
+                    if account_id is not None and hasattr(factory, 'warm_up'):
+                        factory.warm_up(account_id)
+                    self.instances[key] = instance
+        return instance
+
+    def customer_client(self, provider, account_id=None):
+        return self.get(provider, 'customer_client', account_id)
+
+    def merchant_client(self, provider, account_id=None):
+        return self.get(provider, 'merchant_client', account_id)
+
+    def single_payment_strategy(self, provider, account_id=None):
+        return self.get(provider, 'single_payment_strategy', account_id)
+
+    def recurring_payment_strategy(self, provider, account_id=None):
+        return self.get(provider, 'recurring_payment_strategy', account_id)
+
+    def single_transfer_strategy(self, provider, account_id=None):
+        return self.get(provider, 'single_transfer_strategy', account_id)
+
+    def recurring_transfer_strategy(self, provider, account_id=None):
+        return self.get(provider, 'recurring_transfer_strategy', account_id)
+
+    def clear(self, provider=None, account_id=None):
+        """drops cached instances, e.g. after the credentials of an account changed"""
+        with self.lock:
+            self.instances = {
+                key: instance for key, instance in self.instances.items()
+                if not ((provider is None or key[0] == provider)
+                        and (account_id is None or key[2] == account_id))
+            }
+
+
+class ProviderStats:
+    """moving averages of the latency of successful calls and of the error rate of one provider"""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, failed):
+        with self.lock:
+            self.calls += 1
+            self.error_rate = self.alpha * float(failed) + (1 - self.alpha) * self.error_rate
+            # a fast failure says nothing about how fast the provider serves payments
+            if not failed:
+                self.latency = elapsed if self.latency is None \
+                    else self.alpha * elapsed + (1 - self.alpha) * self.latency
+
+    def score(self, error_penalty):
+        """
+        lower is better: latency plus error_penalty seconds per unit of error
+        rate, providers without calls yet score 0 so they get tried
+        """
+        with self.lock:
+            return (self.latency or 0.0) + error_penalty * self.error_rate
+
+
+class RoutingFactory(FinancialProviderFactory):
+    """
+    Factory routing single payments between several providers
+
+    *** factories maps provider names to concrete factories, in order of preference.
+    *** every payment goes to the allowed and available provider with the best
+    *** score: latency of its successful calls plus error_penalty seconds per
+    *** unit of error rate. a call fails when it raises or when the factory's
+    *** is_failed_result() rejects its result, e.g. a 5xx handed back after retries.
+    *** a provider whose factory reports it unavailable (e.g. its circuit
+    *** breaker is open) is skipped, and when the factory's
+    *** is_unavailable_error() says nothing of a failed call was sent it is
+    *** retried on the next provider. other errors are raised as the payment
+    *** may have reached the provider.
+    *** constraints maps a merchant to the providers it may use, it can also be
+    *** a callable(merchant_id) returning them, None means all providers.
+    *** other create_* calls go to the first allowed provider.
+
+    """
+
+    def __init__(self, factories, constraints=None, error_penalty=2.0):
+        self.factories = dict(factories)
+        self.constraints = constraints
+        self.error_penalty = error_penalty
+        self.stats = {provider: ProviderStats() for provider in self.factories}
+
+    def allowed_providers(self, merchant_id=None):
+        allowed = None
+        if callable(self.constraints):
+            allowed = self.constraints(merchant_id)
+        elif self.constraints is not None:
+            allowed = self.constraints.get(merchant_id)
+        providers = [
+            provider for provider in self.factories if allowed is None or provider in allowed
+        ]
+        if not providers:
+            raise ValueError(f'No payment provider allowed for merchant {merchant_id}')
+        return providers
+
+    def candidates(self, merchant_id=None):
+        """allowed providers, available ones first, each group ordered by score"""
+        providers = self.allowed_providers(merchant_id)
+        available = [
+            provider for provider in providers
+            if getattr(self.factories[provider], 'is_available', lambda: True)()
+        ]
+        unavailable = [provider for provider in providers if provider not in available]
+        available.sort(key=lambda provider: self.stats[provider].score(self.error_penalty))
+        return available + unavailable
+
+    def call(self, merchant_id, method, *args, **kwargs):
+        """runs method of the single payment strategy of the best provider, returns (provider, result)"""
+        last_error = None
+        for provider in self.candidates(merchant_id):
+            factory = self.factories[provider]
+            strategy = factory.create_single_payment_strategy()
+            start = time.perf_counter()
+            try:
+                result = getattr(strategy, method)(*args, **kwargs)
+            except Exception as e:
+                if getattr(factory, 'is_unavailable_error', lambda error: False)(e):
+                    last_error = e
+                    continue
+                self.stats[provider].record(time.perf_counter() - start, True)
+                raise
+            failed = getattr(factory, 'is_failed_result', lambda result: False)(result)
+            self.stats[provider].record(time.perf_counter() - start, failed)
+            return provider, result
+        raise last_error
+
+    def metrics(self):
+        return {
+            provider: {'latency': stats.latency, 'error_rate': stats.error_rate,
+                       'calls': stats.calls}
+            for provider, stats in self.stats.items()
+        }
+
+    def primary(self, merchant_id=None):
+        return self.factories[self.allowed_providers(merchant_id)[0]]
+
+    # FinancialProviderRegistry passes the account as account_id, routing
+    # constraints are keyed by that same merchant account
+
+    def create_customer_client(self, *args, merchant_id=None, account_id=None, **kwargs):
+        return self.primary(merchant_id or account_id).create_customer_client(*args, **kwargs)
+
+    def create_merchant_client(self, *args, merchant_id=None, account_id=None, **kwargs):
+        return self.primary(merchant_id or account_id).create_merchant_client(*args, **kwargs)
+
+    def create_single_payment_strategy(self, *args, merchant_id=None, account_id=None, **kwargs):
+        return RoutedSinglePaymentStrategy(self, merchant_id or account_id)
+
+    def create_recurring_payment_strategy(self, *args, merchant_id=None, account_id=None,
+                                          **kwargs):
+        return self.primary(merchant_id or account_id).create_recurring_payment_strategy(
+            *args, **kwargs)
+
+    def create_single_transfer_strategy(self, *args, merchant_id=None, account_id=None,
+                                        **kwargs):
+        return self.primary(merchant_id or account_id).create_single_transfer_strategy(
+            *args, **kwargs)
+
+    def create_recurring_transfer_strategy(self, *args, merchant_id=None, account_id=None,
+                                           **kwargs):
+        return self.primary(merchant_id or account_id).create_recurring_transfer_strategy(
+            *args, **kwargs)
+
+
+# provider of the last payment routed in the current thread or task
+routed_provider = ContextVar('routed_provider', default=None)
+
+
+class RoutedSinglePaymentStrategy(AbstractSinglePayment):
+    """
+    single payment strategy of a RoutingFactory, keeps no per-payment state so
+    one instance can be cached and shared between threads.
+    initiate_payment returns the provider's result unchanged, the provider it
+    was routed to is returned by last_provider() in the same thread or task,
+    route_payment returns both at once. retrieve_payment and update_payment go
+    to `provider`, by default the one of the last payment routed here.
+    """
+
+    def __init__(self, router, merchant_id=None):
+        super().__init__()
+        self.router = router
+        self.merchant_id = merchant_id
+
+    def route_payment(self, *args, **kwargs):
+        """initiates a payment and returns (provider, result)"""
+        provider, result = self.router.call(self.merchant_id, 'initiate_payment', *args, **kwargs)
+        routed_provider.set(provider)
+        return provider, result
+
+    def initiate_payment(self, *args, **kwargs):
+        return self.route_payment(*args, **kwargs)[1]
+
+    @staticmethod
+    def last_provider():
+        return routed_provider.get()
+
+    def strategy_of(self, provider=None):
+        provider = provider or self.last_provider()
+        if provider not in self.router.factories:
+            raise ValueError(f'Unknown payment provider {provider}, pass the provider '
+                             f'the payment was routed to')
+        return self.router.factories[provider].create_single_payment_strategy()
+
+    def retrieve_payment(self, *args, provider=None, **kwargs):
+        return self.strategy_of(provider).retrieve_payment(*args, **kwargs)
+
+    def update_payment(self, *args, provider=None, **kwargs):
+        return self.strategy_of(provider).update_payment(*args, **kwargs)
+
+
+financial_providers = FinancialProviderRegistry()
+financial_providers.register('helcim', HelcimFactory)
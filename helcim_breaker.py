@@ -0,0 +1,145 @@
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RECOVERY_TIMEOUT = 30   # seconds an open breaker waits before a trial call
+DEFAULT_HALF_OPEN_CALLS = 1
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class HelcimCircuitOpenError(Exception):
+    """
+    raised instead of calling an endpoint whose circuit breaker is open,
+    request_sent tells whether an earlier attempt of the same call may have
+    reached Helcim, it stays True unless the caller knows better
+    """
+
+    def __init__(self, endpoint, retry_after):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        self.request_sent = True
+        super().__init__(
+            f'Helcim endpoint {endpoint} is unavailable, '
+            f'circuit breaker open for another {retry_after:.1f}s'
+        )
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a single Helcim endpoint
+
+    *** closed: calls go through and consecutive failures are counted.
+    *** open: after failure_threshold failures calls fail fast with
+    *** HelcimCircuitOpenError until recovery_timeout has passed.
+    *** half_open: a limited number of trial calls are let through, a success
+    *** closes the breaker and a failure opens it again.
+
+    """
+
+    def __init__(self, endpoint, failure_threshold=None, recovery_timeout=None,
+                 half_open_calls=None):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold or getattr(
+            settings, 'HELCIM_BREAKER_FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD)
+        self.recovery_timeout = recovery_timeout or getattr(
+            settings, 'HELCIM_BREAKER_RECOVERY_TIMEOUT', DEFAULT_RECOVERY_TIMEOUT)
+        self.half_open_calls = half_open_calls or getattr(
+            settings, 'HELCIM_BREAKER_HALF_OPEN_CALLS', DEFAULT_HALF_OPEN_CALLS)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_calls = 0
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == OPEN:
+                remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+                if remaining > 0:
+                    raise HelcimCircuitOpenError(self.endpoint, remaining)
+                self.state = HALF_OPEN
+                self.trial_calls = 0
+            if self.state == HALF_OPEN:
+                if self.trial_calls >= self.half_open_calls:
+                    raise HelcimCircuitOpenError(self.endpoint, self.recovery_timeout)
+                self.trial_calls += 1
+
+    def cancel_call(self):
+        """
+        gives back the slot of a call that ended without an outcome, e.g. one
+        interrupted by a gevent Timeout or KeyboardInterrupt, so a half-open
+        breaker doesn't keep refusing calls waiting for a trial that never ends
+        """
+        with self.lock:
+            if self.state == HALF_OPEN and self.trial_calls > 0:
+                self.trial_calls -= 1
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logger.info(f'Helcim circuit breaker for {self.endpoint} closed')
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.error(
+                        f'Helcim circuit breaker for {self.endpoint} opened '
+                        f'after {self.failures} failures'
+                    )
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def is_open(self):
+        with self.lock:
+            return self.state == OPEN and \
+                self.opened_at + self.recovery_timeout > time.monotonic()
+
+
+class CircuitBreakerRegistry:
+    """keeps one CircuitBreaker per endpoint, ids in the url path are collapsed"""
+
+    id_segment = re.compile(r'\d')
+    version_segment = re.compile(r'^v\d+$')
+
+    def __init__(self, **breaker_kwargs):
+        self.breaker_kwargs = breaker_kwargs
+        self.breakers = dict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def endpoint(cls, method, url):
+        """e.g. GET https://api.helcim.com/v2/customers/123/cards -> GET /v2/customers/{id}/cards"""
+        segments = [
+            '{id}' if cls.id_segment.search(segment) and not cls.version_segment.match(segment)
+            else segment
+            for segment in urlsplit(url).path.strip('/').split('/')
+        ]
+        return f'{method} /' + '/'.join(segments)
+
+    def get(self, method, url):
+        endpoint = self.endpoint(method, url)
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    endpoint, CircuitBreaker(endpoint, **self.breaker_kwargs))
+        return breaker
+
+    def states(self):
+        with self.lock:
+            return {endpoint: breaker.state for endpoint, breaker in self.breakers.items()}
@@ -0,0 +1,59 @@
+import logging
+from copy import deepcopy
+
+from django.conf import settings
+
+from cache_utils import TTLCache
+
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_CARDS_CACHE_SIZE = 1024
+DEFAULT_CARDS_CACHE_TTL = 300   # seconds
+DEFAULT_INVOICE_CACHE_SIZE = 10000
+DEFAULT_INVOICE_CACHE_TTL = 60   # only used with HELCIM_CACHE_OPEN_INVOICES
+DEFAULT_FINAL_INVOICE_CACHE_TTL = 24 * 60 * 60
+
+# invoices in these statuses don't change anymore
+FINAL_INVOICE_STATUSES = ('PAID', 'CANCELLED')
+
+
+customer_cards_cache = TTLCache(
+    maxsize=getattr(settings, 'HELCIM_CARDS_CACHE_SIZE', DEFAULT_CARDS_CACHE_SIZE),
+    ttl=getattr(settings, 'HELCIM_CARDS_CACHE_TTL', DEFAULT_CARDS_CACHE_TTL),
+)
+
+invoice_cache = TTLCache(
+    maxsize=getattr(settings, 'HELCIM_INVOICE_CACHE_SIZE', DEFAULT_INVOICE_CACHE_SIZE),
+    ttl=getattr(settings, 'HELCIM_INVOICE_CACHE_TTL', DEFAULT_INVOICE_CACHE_TTL),
+)
+
+
+def get_cached_invoice(account_id, key_type, value):
+    """key_type is 'id' or 'number', returns a copy of the invoice or None"""
+    invoice = invoice_cache.get((account_id, key_type, str(value)))
+    if invoice is None:
+        return None
+    return deepcopy(invoice)
+
+
+def cache_invoice(account_id, invoice):
+    """
+    caches an invoice under both its id and its number. only paid and
+    cancelled invoices, which can't change anymore, are cached unless
+    HELCIM_CACHE_OPEN_INVOICES is True, then other invoices are kept for
+    HELCIM_INVOICE_CACHE_TTL seconds and may be read as due after being paid
+    """
+    if not isinstance(invoice, dict):
+        return
+    if invoice.get('status') in FINAL_INVOICE_STATUSES:
+        ttl = getattr(settings, 'HELCIM_FINAL_INVOICE_CACHE_TTL', DEFAULT_FINAL_INVOICE_CACHE_TTL)
+    elif getattr(settings, 'HELCIM_CACHE_OPEN_INVOICES', False):
+        ttl = None
+    else:
+        return
+    invoice = deepcopy(invoice)
+    if invoice.get('invoiceId', None) is not None:
+        invoice_cache.set((account_id, 'id', str(invoice['invoiceId'])), invoice, ttl)
+    if invoice.get('invoiceNumber', None) is not None:
+        invoice_cache.set((account_id, 'number', str(invoice['invoiceNumber'])), invoice, ttl)
@@ -0,0 +1,129 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from helcim_provider_refactor import HelcimTransfer
+from helcim_rate_limit import HelcimRateLimitError
+
+
+logger = logging.getLogger(__file__)
+
+error_logs_prefix = 'Payment Package error in:'
+
+# at the default rate limit of 10 requests per second an api-token queue of
+# 10 workers stays around 1s, well under HELCIM_RATE_LIMIT_MAX_WAIT
+DEFAULT_PAYOUT_WORKERS = 10
+
+# operation_id identifies the payout (e.g. a payout file line id), the
+# idempotency-key of the row is derived from it so a re-run doesn't pay twice
+PayoutRow = namedtuple(
+    'PayoutRow', ['account_id', 'customer_code', 'amount', 'bank_token', 'operation_id'],
+    defaults=(None,)
+)
+
+PayoutResult = namedtuple('PayoutResult', ['index', 'row', 'response', 'error'])
+
+
+def default_lane_key(row):
+    """payouts to the same customer of the same merchant account are kept in order"""
+    return row.account_id, row.customer_code
+
+
+class HelcimBulkPayout:
+    """
+    Bulk payout engine on top of HelcimTransfer.transfer
+
+    *** rows are grouped into lanes by lane_key, each lane is sent in
+    *** submission order by a single worker while different lanes run in
+    *** parallel on a bounded pool, so throughput is bound by the Helcim
+    *** rate limit and the pool size instead of serial round trips.
+    *** results are streamed back as PayoutResult tuples as soon as each
+    *** row finishes, a failed row carries its exception in `error`.
+    *** every row gets its own idempotency-key, derived from its operation_id
+    *** or random when it has none, so only rows with an operation_id can be
+    *** safely sent again after a crash.
+    *** a row refused by the client side rate limiter was never sent, its lane
+    *** waits for the bucket and sends it again before moving on, so rows are
+    *** neither failed nor overtaken because of throttling.
+
+    """
+
+    def __init__(self, max_workers=None, lane_key=None, currency='CAD', **api_kwargs):
+        self.max_workers = max_workers or getattr(
+            settings, 'HELCIM_PAYOUT_WORKERS', DEFAULT_PAYOUT_WORKERS)
+        self.lane_key = lane_key or default_lane_key
+        self.currency = currency
+        for name in ('idempotency_key', 'operation_id'):
+            if name in api_kwargs:
+                raise ValueError(
+                    f'{name} would be shared by every payout, set operation_id on each PayoutRow')
+        self.api_kwargs = api_kwargs
+
+    def _build_lanes(self, rows):
+        lanes = dict()
+        for index, row in enumerate(rows):
+            row = row if isinstance(row, PayoutRow) else PayoutRow(*row)
+            lanes.setdefault(self.lane_key(row), []).append((index, row))
+        return lanes
+
+    def _transfer(self, index, row, cancelled):
+        api_kwargs = dict(self.api_kwargs)
+        if row.operation_id is not None:
+            api_kwargs['operation_id'] = row.operation_id
+        while True:
+            try:
+                response = HelcimTransfer.transfer(
+                    row.account_id,
+                    row.customer_code,
+                    row.amount,
+                    row.bank_token,
+                    currency=self.currency,
+                    **api_kwargs
+                )
+                return PayoutResult(index, row, response, None)
+            except HelcimRateLimitError as e:
+                if cancelled.is_set():
+                    return PayoutResult(index, row, None, e)
+                # sleep until the token is within max_queue_wait and try again
+                time.sleep(e.wait - e.max_queue_wait)
+            except Exception as e:
+                logger.error(
+                    f'{error_logs_prefix} {self._transfer.__qualname__} '
+                    f'row {index}: {str(e)}'
+                )
+                return PayoutResult(index, row, None, e)
+
+    def _run_lane(self, lane, results, cancelled):
+        for index, row in lane:
+            if cancelled.is_set():
+                return
+            results.put(self._transfer(index, row, cancelled))
+
+    def run(self, rows):
+        """yields a PayoutResult for every row in completion order"""
+        lanes = self._build_lanes(rows)
+        total = sum(len(lane) for lane in lanes.values())
+        results = queue.Queue()
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(lanes)) or 1,
+            thread_name_prefix='helcim-payout'
+        )
+        try:
+            for lane in lanes.values():
+                executor.submit(self._run_lane, lane, results, cancelled)
+            for _ in range(total):
+                yield results.get()
+        finally:
+            # stop lanes from starting new rows if the caller stops consuming early
+            cancelled.set()
+            executor.shutdown(wait=True)
+
+
+def bulk_transfer(rows, max_workers=None, **kwargs):
+    return HelcimBulkPayout(max_workers=max_workers, **kwargs).run(rows)
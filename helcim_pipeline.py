@@ -0,0 +1,252 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from helcim_retry import RetryPolicy, idempotency_key
+from helcim_server_address import server_address
+from helcim_transport import HELCIM_API_URL, get_transport
+
+
+logger = logging.getLogger(__file__)
+
+error_logs_prefix = 'Payment Package error in:'
+
+# what ErrorMappingStage does with a response carrying `errors`
+RAISE_ERRORS = 'raise'
+LOG_ERRORS = 'log'      # log it and return {'status': 'ERROR'}
+IGNORE_ERRORS = None    # hand the response back untouched
+
+
+class HelcimApiError(Exception):
+    """raised when Helcim answers with an `errors` payload"""
+
+    def __init__(self, message, errors=None):
+        self.errors = errors
+        super().__init__(message)
+
+
+class HelcimRequest:
+    """
+    Description of a single Helcim api call
+
+    *** provider methods only describe the call: endpoint, account, body and
+    *** how errors should be surfaced, the pipeline stages fill in headers,
+    *** idempotency key and ip address and take care of sending it.
+
+    """
+
+    def __init__(self, name, method, path, account_id, json=None, params=None,
+                 operation=None, errors=RAISE_ERRORS, with_ip_address=False, api_kwargs=None):
+        self.name = name    # used in error messages, usually a method __qualname__
+        self.method = method
+        self.path = path
+        self.url = HELCIM_API_URL + path
+        self.account_id = account_id
+        self.json = json
+        self.params = params
+        self.operation = operation    # set for writes that need an idempotency-key
+        self.errors = errors
+        self.with_ip_address = with_ip_address
+        self.api_kwargs = api_kwargs or dict()
+        self.headers = dict()
+
+
+class TimingStage:
+    """keeps count, failures and latency of every request name"""
+
+    def __init__(self):
+        self.stats = dict()
+        self.lock = threading.Lock()
+
+    def __call__(self, request, call_next):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = call_next(request)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats = self.stats.setdefault(
+                    request.name, {'count': 0, 'failures': 0, 'total_time': 0.0, 'max_time': 0.0})
+                stats['count'] += 1
+                stats['failures'] += int(failed)
+                stats['total_time'] += elapsed
+                stats['max_time'] = max(stats['max_time'], elapsed)
+            logger.debug(f'Helcim {request.name} took {elapsed:.3f}s')
+
+    def metrics(self):
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+
+class AuthHeadersStage:
+    """adds the static headers of an account, built once per account and reused"""
+
+    def __init__(self):
+        self.headers = dict()
+
+    def static_headers(self, account_id, has_body):
+        key = (account_id, has_body)
+        headers = self.headers.get(key)
+        if headers is None:
+            headers = {
+                "accept": "application/json",
+                "api-token": f"{account_id}",
+            }
+            if has_body:
+                headers['content-type'] = "application/json"
+            if getattr(settings, 'HELCIM_PARTNER_TOKEN', None):
+                headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
+            self.headers[key] = headers
+        return headers
+
+    def __call__(self, request, call_next):
+        request.headers.update(self.static_headers(request.account_id, request.json is not None))
+        return call_next(request)
+
+
+class IdempotencyStage:
+    """adds the idempotency-key of writes, before retries so they all reuse it"""
+
+    def __call__(self, request, call_next):
+        if request.operation:
+            request.headers['idempotency-key'] = idempotency_key(
+                request.account_id, request.operation, request.api_kwargs)
+        return call_next(request)
+
+
+class IpAddressStage:
+    """fills ipAddress of payment payloads, an `ipAddress` kwarg wins over the server ip"""
+
+    def __init__(self, server_address=server_address):
+        # resolved by warm_up() at startup, or lazily by the first payment
+        self.server_address = server_address
+
+    def __call__(self, request, call_next):
+        if request.with_ip_address:
+            request.json['ipAddress'] = request.api_kwargs.get('ipAddress', None) \
+                or self.server_address.get()
+        return call_next(request)
+
+
+class ErrorMappingStage:
+    """turns an `errors` payload into HelcimApiError or {'status': 'ERROR'}"""
+
+    def __call__(self, request, call_next):
+        json_response = call_next(request)
+        if request.errors and isinstance(json_response, dict) \
+                and json_response.get('errors', None):
+            message = f'{error_logs_prefix} {request.name} {str(json_response["errors"])}'
+            if request.errors == LOG_ERRORS:
+                logger.error(message)
+                return {'status': 'ERROR'}
+            raise HelcimApiError(message, json_response['errors'])
+        return json_response
+
+
+class DecodeStage:
+    def __call__(self, request, call_next):
+        return call_next(request).json()
+
+
+class RetryStage:
+    """retries the rest of the pipeline with RetryPolicy"""
+
+    def __init__(self, retry_policy=None):
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def __call__(self, request, call_next):
+        return self.retry_policy.call(
+            lambda method, url, **kwargs: call_next(request),
+            request.method, request.url, headers=request.headers
+        )
+
+
+class HelcimRequestPipeline:
+    """
+    Single request path of every Helcim api call
+
+    *** a request goes through the stages in order, each stage is a callable
+    *** taking (request, call_next), the last one hands it to the pooled
+    *** transport which applies timeouts, rate limiting and circuit breaking.
+    *** new behaviour is added by inserting a stage, not by editing providers.
+
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, stages=None, transport=None):
+        self.stages = stages if stages is not None else self.default_stages()
+        self.transport = transport
+
+    @staticmethod
+    def default_stages():
+        return [
+            TimingStage(),
+            AuthHeadersStage(),
+            IdempotencyStage(),
+            IpAddressStage(),
+            ErrorMappingStage(),
+            DecodeStage(),
+            RetryStage(),
+        ]
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def add_stage(self, stage, index=None):
+        """inserts a stage, by default right before the request is sent"""
+        self.stages.insert(len(self.stages) if index is None else index, stage)
+
+    def get_stage(self, stage_class):
+        for stage in self.stages:
+            if isinstance(stage, stage_class):
+                return stage
+        return None
+
+    def send(self, request):
+        return self._call(0, request)
+
+    def _call(self, index, request):
+        if index == len(self.stages):
+            return self.dispatch(request)
+        return self.stages[index](request, lambda request: self._call(index + 1, request))
+
+    def dispatch(self, request):
+        transport = self.transport or get_transport()
+        return transport.request(
+            request.method, request.url,
+            json=request.json, params=request.params, headers=request.headers
+        )
+
+
+def get_pipeline():
+    return HelcimRequestPipeline.instance()
+
+
+def warm_up():
+    """
+    startup hook, meant to be called from AppConfig.ready()
+
+    *** builds the pipeline and the pooled transport and resolves the server
+    *** ip address so the first charge doesn't pay for them, after that the
+    *** address is kept fresh by its refresh timer.
+    *** HELCIM_SERVER_ADDRESS_SIGHUP = True also lets SIGHUP refresh it, it is
+    *** off by default as app servers (uWSGI, gunicorn) use SIGHUP to reload
+    *** workers. signal handlers can only be installed from the main thread.
+    """
+    get_pipeline()
+    get_transport()
+    server_address.resolve()
+    if getattr(settings, 'HELCIM_SERVER_ADDRESS_SIGHUP', False) \
+            and threading.current_thread() is threading.main_thread():
+        server_address.install_signal_handler()
@@ -1,12 +1,9 @@
 import logging
-import requests
-from uuid import uuid4
-from .abstract_classes import *
-from payment.utils import (
-    get_current_server,
-    three_letter_abbreviation_of_the_country
-)
-from payment.utils import get_current_server
+from concurrent.futures import ThreadPoolExecutor
+from abstract_classes import *
+from helcim_cache import cache_invoice, customer_cards_cache, get_cached_invoice
+from helcim_pipeline import HelcimRequest, IGNORE_ERRORS, LOG_ERRORS, get_pipeline
+from payment.utils import three_letter_abbreviation_of_the_country
 from typing import Literal
 
 from django.conf import settings
@@ -16,6 +13,8 @@ logger = logging.getLogger(__file__)
 
 error_logs_prefix = 'Payment Package error in:'
 
+DEFAULT_INVOICE_BATCH_WORKERS = 10
+
 
 bank_account_type = Literal[
     'CHECKING',
@@ -29,12 +28,27 @@ bank_account_corporate = Literal[
 
 
 class HelcimClinet(AbstractClient):
+    """
+    *** every api method is split in a *_request classmethod that describes
+    *** the call as a HelcimRequest and, where the payload needs reshaping,
+    *** a *_response classmethod. headers, idempotency, retries and error
+    *** mapping are done by the request pipeline, so the sync methods below
+    *** and the asyncio client in helcim_provider_async stay thin.
+    """
 
     @classmethod
     def create_customer(
         cls,
         account_id,
         **kwargs
+    ):
+        return get_pipeline().send(cls.create_customer_request(account_id, **kwargs))
+
+    @classmethod
+    def create_customer_request(
+        cls,
+        account_id,
+        **kwargs
     ):
         api_kwargs = dict()
         if not (kwargs.get('first_name',None) or kwargs.get('last_name', None)):
@@ -73,27 +87,11 @@ class HelcimClinet(AbstractClient):
                 api_kwargs['billingAddress']['city'] = kwargs["city"]
             if kwargs.get('email', None):
                 api_kwargs['billingAddress']['email'] = kwargs["email"]
-            
-        url = "https://api.helcim.com/v2/customers/"
 
-        headers = {
-                "accept": "application/json",
-                "content-type": "application/json",
-                "api-token": account_id,
-            }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        
-        response = requests.post(url, json=api_kwargs, headers=headers)
-
-        json_response = response.json()
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.create_customer.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return HelcimRequest(
+            cls.create_customer.__qualname__, 'POST', '/v2/customers/', account_id,
+            json=api_kwargs,
+        )
 
     @classmethod
     def create_account_link(
@@ -108,6 +106,15 @@ class HelcimClinet(AbstractClient):
 
     @classmethod
     def create_bank_account(
+        cls,
+        account_id,
+        *args,
+        **kwargs
+    ):
+        return get_pipeline().send(cls.create_bank_account_request(account_id, *args, **kwargs))
+
+    @classmethod
+    def create_bank_account_request(
         cls,
         account_id,
         account_number,
@@ -128,7 +135,7 @@ class HelcimClinet(AbstractClient):
         account_corporate: bank_account_corporate = 'PERSONAL',
         **api_kwargs
     ):
-        api_kwargs = {
+        payload = {
             "bankData": {
                 "firstName": first_name,
                 "lastName": last_name,
@@ -144,39 +151,20 @@ class HelcimClinet(AbstractClient):
                 "province": state,
                 "postalCode": postal_code
             },
-            "ipAddress": get_current_server(),
             "currency": currency,
             "amount": 0,
             "customerCode": helcim_customer_code
         }
-        if api_kwargs.get('ipAddress', None):
-            api_kwargs["ipAddress"] = api_kwargs["ipAddress"]
-        else:
-            api_kwargs["ipAddress"] = get_current_server()
         if company_name:
-            api_kwargs['bankData']['companyName'] = company_name
+            payload['bankData']['companyName'] = company_name
         else:
-            api_kwargs['bankData']['companyName'] = last_name
+            payload['bankData']['companyName'] = last_name
 
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        url = "https://api.helcim.com/v2/payment/withdraw"
-        response = requests.post(url, json=api_kwargs, headers=headers)
-
-        json_response = response.json()
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.create_bank_account.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return HelcimRequest(
+            cls.create_bank_account.__qualname__, 'POST', '/v2/payment/withdraw', account_id,
+            json=payload, operation='create_bank_account', with_ip_address=True,
+            api_kwargs=api_kwargs,
+        )
 
     @classmethod
     def get_customer_cards(
@@ -185,36 +173,60 @@ class HelcimClinet(AbstractClient):
         customer_id: str,
         **api_kwargs
     ):
-        url = f"https://api.helcim.com/v2/customers/{customer_id}/cards"
-        headers = {
-            "accept": "application/json",
-            "api-token": f"{account_id}"
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        response = requests.get(url, headers = headers)
-        json_response = response.json()
-        if isinstance(json_response, dict) and json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.get_customer_cards.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            cards = list()
-            for item in json_response:
-                payment_method = {
-                    'funding_id': item['cardToken'],
-                    'last4': item['cardF6L4'][-4:],
-                    'exp_month': item['cardExpiry'][:2],
-                    'exp_year': item['cardExpiry'][2:],
-                    'brand': None,
-                }
-                cards.append(payment_method)
+        cards = cls.get_cached_customer_cards(account_id, customer_id)
+        if cards is not None:
             return cards
+        json_response = get_pipeline().send(cls.get_customer_cards_request(account_id, customer_id))
+        cards = cls.get_customer_cards_response(json_response)
+        cls.cache_customer_cards(account_id, customer_id, cards)
+        return cards
+
+    @classmethod
+    def get_cached_customer_cards(cls, account_id, customer_id):
+        """returns a copy of the cached card list or None"""
+        cards = customer_cards_cache.get((account_id, customer_id))
+        if cards is None:
+            return None
+        return [dict(card) for card in cards]
+
+    @classmethod
+    def cache_customer_cards(cls, account_id, customer_id, cards):
+        customer_cards_cache.set(
+            (account_id, customer_id), tuple(dict(card) for card in cards))
+
+    @classmethod
+    def invalidate_customer_cards(cls, account_id, customer_id):
+        """must be called whenever a card is added to or removed from a customer"""
+        customer_cards_cache.delete((account_id, customer_id))
+
+    @classmethod
+    def get_customer_cards_request(
+        cls,
+        account_id: str,
+        customer_id: str,
+    ):
+        return HelcimRequest(
+            cls.get_customer_cards.__qualname__, 'GET', f'/v2/customers/{customer_id}/cards',
+            account_id,
+        )
+
+    @classmethod
+    def get_customer_cards_response(cls, json_response):
+        cards = list()
+        for item in json_response:
+            payment_method = {
+                'funding_id': item['cardToken'],
+                'last4': item['cardF6L4'][-4:],
+                'exp_month': item['cardExpiry'][:2],
+                'exp_year': item['cardExpiry'][2:],
+                'brand': None,
+            }
+            cards.append(payment_method)
+        return cards
 
 
 class HelcimPayment(AbstractPayment):
-    
+
     @classmethod
     def payment(
         cls,
@@ -226,35 +238,45 @@ class HelcimPayment(AbstractPayment):
         currency: str = 'CAD',
         **api_kwargs
     ):
-        url = "https://api.helcim.com/v2/payment/purchase"
+        json_response = get_pipeline().send(cls.payment_request(
+            account_id, amount, funding_id, customer_id, customer_code, currency, **api_kwargs))
+        cls.refresh_customer_cards(account_id, customer_id, funding_id, json_response)
+        return json_response
+
+    @classmethod
+    def payment_request(
+        cls,
+        account_id: str,
+        amount: float,
+        funding_id: str,
+        customer_id: str = None,
+        customer_code: str = None,
+        currency: str = 'CAD',
+        **api_kwargs
+    ):
         payload = {
             "cardData": { "cardToken": funding_id },
             "currency": currency,
             "amount": str(amount),
             "customerCode": customer_code,
         }
-        if api_kwargs.get('ipAddress', None):
-            payload["ipAddress"] = api_kwargs["ipAddress"]
-        else:
-            payload["ipAddress"] = get_current_server()
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id,
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        response = requests.post(url, json=payload, headers=headers)
-        json_response = response.json()
-        if json_response.get('errors', None):
-            logger.exception(
-                f'{error_logs_prefix} {cls.payment.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-            return {'status': 'ERROR'}
-        else:
-            return json_response
+        return HelcimRequest(
+            cls.payment.__qualname__, 'POST', '/v2/payment/purchase', account_id,
+            json=payload, operation='payment', errors=LOG_ERRORS, with_ip_address=True,
+            api_kwargs=api_kwargs,
+        )
+
+    @classmethod
+    def refresh_customer_cards(cls, account_id, customer_id, funding_id, json_response):
+        """
+        a successful payment with a card token that is not in the cached
+        card list means a new card was saved, so the cached list is dropped
+        """
+        if not customer_id or json_response.get('status') == 'ERROR':
+            return
+        cards = HelcimClinet.get_cached_customer_cards(account_id, customer_id)
+        if cards is not None and funding_id not in [card['funding_id'] for card in cards]:
+            HelcimClinet.invalidate_customer_cards(account_id, customer_id)
 
     @classmethod
     def get_invoice_by_invoice_number(
@@ -262,37 +284,94 @@ class HelcimPayment(AbstractPayment):
         account_id: str,
         invoice_number: str,
     ):
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        url = f"https://api.helcim.com/v2/invoices/?invoiceNumber={invoice_number}"
-        response = requests.get(url, headers=headers)
-        invoice_data = response.json()[0]
+        invoice_data = get_cached_invoice(account_id, 'number', invoice_number)
+        if invoice_data is not None:
+            return invoice_data
+        json_response = get_pipeline().send(
+            cls.get_invoice_by_invoice_number_request(account_id, invoice_number))
+        invoice_data = cls.get_invoice_by_invoice_number_response(json_response)
+        cache_invoice(account_id, invoice_data)
         return invoice_data
-    
+
+    @classmethod
+    def get_invoice_by_invoice_number_request(
+        cls,
+        account_id: str,
+        invoice_number: str,
+    ):
+        return HelcimRequest(
+            cls.get_invoice_by_invoice_number.__qualname__, 'GET', '/v2/invoices/', account_id,
+            params={'invoiceNumber': invoice_number}, errors=IGNORE_ERRORS,
+        )
+
+    @classmethod
+    def get_invoice_by_invoice_number_response(cls, json_response):
+        invoice_data = json_response[0]
+        return invoice_data
+
     @classmethod
     def get_invoice_by_invoice_id(
         cls,
         account_id: str,
         invoice_id: str,
     ):
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        url = f"https://api.helcim.com/v2/invoices/{invoice_id}"
-        response = requests.get(url, headers=headers)
-        invoice_data = response.json()
+        invoice_data = get_cached_invoice(account_id, 'id', invoice_id)
+        if invoice_data is not None:
+            return invoice_data
+        invoice_data = get_pipeline().send(
+            cls.get_invoice_by_invoice_id_request(account_id, invoice_id))
+        cache_invoice(account_id, invoice_data)
         return invoice_data
 
+    @classmethod
+    def get_invoice_by_invoice_id_request(
+        cls,
+        account_id: str,
+        invoice_id: str,
+    ):
+        return HelcimRequest(
+            cls.get_invoice_by_invoice_id.__qualname__, 'GET', f'/v2/invoices/{invoice_id}',
+            account_id, errors=IGNORE_ERRORS,
+        )
+
+    @classmethod
+    def get_invoices_by_invoice_id(cls, account_id: str, invoice_ids, max_workers=None):
+        """returns a dict of invoice_id -> invoice, lookups that raise map to None"""
+        return cls.get_invoices(cls.get_invoice_by_invoice_id, account_id, invoice_ids, max_workers)
+
+    @classmethod
+    def get_invoices_by_invoice_number(cls, account_id: str, invoice_numbers, max_workers=None):
+        """returns a dict of invoice_number -> invoice, lookups that raise map to None"""
+        return cls.get_invoices(
+            cls.get_invoice_by_invoice_number, account_id, invoice_numbers, max_workers)
+
+    @classmethod
+    def get_invoices(cls, lookup, account_id, keys, max_workers=None):
+        """
+        runs lookup for every key on a bounded thread pool, cached invoices
+        are answered without a request and fetched ones fill the cache for
+        both their id and number
+        """
+        keys = list(dict.fromkeys(keys))
+        max_workers = max_workers or getattr(
+            settings, 'HELCIM_INVOICE_BATCH_WORKERS', DEFAULT_INVOICE_BATCH_WORKERS)
+
+        def fetch(key):
+            try:
+                return lookup(account_id, key)
+            except Exception as e:
+                logger.error(
+                    f'{error_logs_prefix} {cls.get_invoices.__qualname__} '
+                    f'{key}: {str(e)}'
+                )
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(keys, executor.map(fetch, keys)))
+
 
 class HelcimTransfer(AbstractTransfer):
-    
+
     @classmethod
     def transfer(
         cls,
@@ -303,34 +382,26 @@ class HelcimTransfer(AbstractTransfer):
         currency: str = 'CAD',
         **api_kwargs
     ):
-        url = "https://api.helcim.com/v2/payment/withdraw"
+        return get_pipeline().send(cls.transfer_request(
+            account_id, helcim_customer_code, amount, bank_token, currency, **api_kwargs))
 
+    @classmethod
+    def transfer_request(
+        cls,
+        account_id,
+        helcim_customer_code,
+        amount: float,
+        bank_token: str,
+        currency: str = 'CAD',
+        **api_kwargs
+    ):
         payload = {
             "bankData": { "bankToken": bank_token },
             "currency": currency,
             "amount": amount,
             "customerCode": helcim_customer_code,
         }
-        if api_kwargs.get('ipAddress', None):
-            payload["ipAddress"] = api_kwargs["ipAddress"]
-        else:
-            payload["ipAddress"] = get_current_server()
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-
-        response = requests.post(url, json=payload, headers=headers)
-        json_response = response.json()
-
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.transfer.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return HelcimRequest(
+            cls.transfer.__qualname__, 'POST', '/v2/payment/withdraw', account_id,
+            json=payload, operation='transfer', with_ip_address=True, api_kwargs=api_kwargs,
+        )
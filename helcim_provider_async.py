@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+from helcim_cache import cache_invoice, get_cached_invoice
+from helcim_pipeline import get_pipeline
+from helcim_provider import HelcimClinet, HelcimPayment, HelcimTransfer
+from helcim_transport import get_async_transport
+
+
+logger = logging.getLogger(__file__)
+
+
+async def send(request):
+    """runs a HelcimRequest through the request pipeline without blocking the loop"""
+    return await get_async_transport().run(get_pipeline().send, request)
+
+
+class AsyncHelcimClinet:
+    """
+    asyncio mirror of HelcimClinet
+
+    *** requests and response reshaping come from the HelcimClinet
+    *** *_request/*_response classmethods, only the pipeline call is awaited.
+
+    """
+
+    @classmethod
+    async def create_customer(cls, account_id, **kwargs):
+        return await send(HelcimClinet.create_customer_request(account_id, **kwargs))
+
+    @classmethod
+    async def create_bank_account(cls, account_id, *args, **kwargs):
+        return await send(HelcimClinet.create_bank_account_request(account_id, *args, **kwargs))
+
+    @classmethod
+    async def get_customer_cards(cls, account_id: str, customer_id: str, **api_kwargs):
+        cards = HelcimClinet.get_cached_customer_cards(account_id, customer_id)
+        if cards is not None:
+            return cards
+        json_response = await send(HelcimClinet.get_customer_cards_request(account_id, customer_id))
+        cards = HelcimClinet.get_customer_cards_response(json_response)
+        HelcimClinet.cache_customer_cards(account_id, customer_id, cards)
+        return cards
+
+    @classmethod
+    async def get_many_customer_cards(cls, account_id: str, customer_ids):
+        """returns a dict of customer_id -> cards, fetched concurrently"""
+        customer_ids = list(customer_ids)
+        results = await asyncio.gather(
+            *[cls.get_customer_cards(account_id, customer_id) for customer_id in customer_ids]
+        )
+        return dict(zip(customer_ids, results))
+
+
+class AsyncHelcimPayment:
+    """asyncio mirror of HelcimPayment"""
+
+    @classmethod
+    async def payment(cls, account_id: str, amount: float, funding_id: str,
+                      customer_id: str = None, *args, **api_kwargs):
+        json_response = await send(HelcimPayment.payment_request(
+            account_id, amount, funding_id, customer_id, *args, **api_kwargs))
+        HelcimPayment.refresh_customer_cards(account_id, customer_id, funding_id, json_response)
+        return json_response
+
+    @classmethod
+    async def get_invoice_by_invoice_number(cls, account_id: str, invoice_number: str):
+        invoice_data = get_cached_invoice(account_id, 'number', invoice_number)
+        if invoice_data is not None:
+            return invoice_data
+        json_response = await send(
+            HelcimPayment.get_invoice_by_invoice_number_request(account_id, invoice_number))
+        invoice_data = HelcimPayment.get_invoice_by_invoice_number_response(json_response)
+        cache_invoice(account_id, invoice_data)
+        return invoice_data
+
+    @classmethod
+    async def get_invoice_by_invoice_id(cls, account_id: str, invoice_id: str):
+        invoice_data = get_cached_invoice(account_id, 'id', invoice_id)
+        if invoice_data is not None:
+            return invoice_data
+        invoice_data = await send(
+            HelcimPayment.get_invoice_by_invoice_id_request(account_id, invoice_id))
+        cache_invoice(account_id, invoice_data)
+        return invoice_data
+
+    @classmethod
+    async def get_invoices_by_invoice_id(cls, account_id: str, invoice_ids):
+        return await cls.get_invoices(cls.get_invoice_by_invoice_id, account_id, invoice_ids)
+
+    @classmethod
+    async def get_invoices_by_invoice_number(cls, account_id: str, invoice_numbers):
+        return await cls.get_invoices(
+            cls.get_invoice_by_invoice_number, account_id, invoice_numbers)
+
+    @classmethod
+    async def get_invoices(cls, lookup, account_id, keys):
+        """concurrent version of HelcimPayment.get_invoices"""
+        keys = list(dict.fromkeys(keys))
+        results = await asyncio.gather(
+            *[lookup(account_id, key) for key in keys], return_exceptions=True)
+        invoices = dict()
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                logger.error(f'{cls.get_invoices.__qualname__} {key}: {str(result)}')
+                result = None
+            invoices[key] = result
+        return invoices
+
+
+class AsyncHelcimTransfer:
+    """asyncio mirror of HelcimTransfer"""
+
+    @classmethod
+    async def transfer(cls, account_id, helcim_customer_code, amount: float, bank_token: str,
+                       *args, **api_kwargs):
+        return await send(HelcimTransfer.transfer_request(
+            account_id, helcim_customer_code, amount, bank_token, *args, **api_kwargs))
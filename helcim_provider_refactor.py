@@ -1,14 +1,11 @@
 import logging
-import requests
-from uuid import uuid4
 from typing import Literal
 
 from MySandBox.abstract_classes import AbstractPayment, AbstractTransfer
 from abstract_classes_refactor import AbstractCustomerClient, AbstractMerchantClient
-from payment.utils import get_current_server
+from helcim_pipeline import HelcimRequest, IGNORE_ERRORS, LOG_ERRORS, get_pipeline
 # from payment.utils import get_current_server, three_letter_abbreviation_of_the_country
 #
-from django.conf import settings
 # from payment.payment_providers.abstract_classes_me import AbstractCustomerClient, AbstractMerchantClient
 # from payment.payment_providers.abstract_classes_me import AbstractPayment, AbstractTransfer
 
@@ -67,26 +64,10 @@ class HelcimCustomerClient(AbstractCustomerClient):
             if kwargs.get('email', None):
                 api_kwargs['billingAddress']['email'] = kwargs["email"]
 
-        url = "https://api.helcim.com/v2/customers/"
-
-        headers = {
-            "accept": "application/json",
-            "content-type": "application/json",
-            "api-token": account_id,
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-
-        response = requests.post(url, json=api_kwargs, headers=headers)
-
-        json_response = response.json()
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.create_customer.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return get_pipeline().send(HelcimRequest(
+            cls.create_customer.__qualname__, 'POST', '/v2/customers/', account_id,
+            json=api_kwargs,
+        ))
 
     @classmethod
     def create_account_link(cls, account_id: str, **api_kwargs):
@@ -117,7 +98,7 @@ class HelcimCustomerClient(AbstractCustomerClient):
             account_corporate: BANK_ACCOUNT_CORPORATE = 'PERSONAL',
             **api_kwargs
     ):
-        api_kwargs = {
+        payload = {
             "bankData": {
                 "firstName": first_name,
                 "lastName": last_name,
@@ -133,72 +114,39 @@ class HelcimCustomerClient(AbstractCustomerClient):
                 "province": state,
                 "postalCode": postal_code
             },
-            "ipAddress": get_current_server(),
             "currency": currency,
             "amount": 0,
             "customerCode": helcim_customer_code
         }
-        if api_kwargs.get('ipAddress', None):
-            api_kwargs["ipAddress"] = api_kwargs["ipAddress"]
-        else:
-            api_kwargs["ipAddress"] = get_current_server()
         if company_name:
-            api_kwargs['bankData']['companyName'] = company_name
+            payload['bankData']['companyName'] = company_name
         else:
-            api_kwargs['bankData']['companyName'] = last_name
-
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        url = "https://api.helcim.com/v2/payment/withdraw"
-        response = requests.post(url, json=api_kwargs, headers=headers)
+            payload['bankData']['companyName'] = last_name
 
-        json_response = response.json()
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.create_bank_account.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return get_pipeline().send(HelcimRequest(
+            cls.create_bank_account.__qualname__, 'POST', '/v2/payment/withdraw', account_id,
+            json=payload, operation='create_bank_account', with_ip_address=True,
+            api_kwargs=api_kwargs,
+        ))
 
     @classmethod
     def get_customer_cards(cls, account_id: str, customer_id: str, **api_kwargs):
-
-        url = f"https://api.helcim.com/v2/customers/{customer_id}/cards"
-        headers = {
-            "accept": "application/json",
-            "api-token": f"{account_id}"
-        }
-
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        response = requests.get(url, headers=headers)
-        json_response = response.json()
-
-        if isinstance(json_response, dict) and json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.get_customer_cards.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-
-        else:
-            cards = list()
-            for item in json_response:
-                payment_method = {
-                    'funding_id': item['cardToken'],
-                    'last4': item['cardF6L4'][-4:],
-                    'exp_month': item['cardExpiry'][:2],
-                    'exp_year': item['cardExpiry'][2:],
-                    'brand': None,
-                }
-                cards.append(payment_method)
-            return cards
+        json_response = get_pipeline().send(HelcimRequest(
+            cls.get_customer_cards.__qualname__, 'GET', f'/v2/customers/{customer_id}/cards',
+            account_id,
+        ))
+
+        cards = list()
+        for item in json_response:
+            payment_method = {
+                'funding_id': item['cardToken'],
+                'last4': item['cardF6L4'][-4:],
+                'exp_month': item['cardExpiry'][:2],
+                'exp_year': item['cardExpiry'][2:],
+                'brand': None,
+            }
+            cards.append(payment_method)
+        return cards
 
     @classmethod
     def retrieve_customer(cls, customer_id):
@@ -252,26 +200,10 @@ class HelcimMerchantClient(AbstractMerchantClient):
             if kwargs.get('email', None):
                 api_kwargs['billingAddress']['email'] = kwargs["email"]
 
-        url = "https://api.helcim.com/v2/customers/"
-
-        headers = {
-            "accept": "application/json",
-            "content-type": "application/json",
-            "api-token": account_id,
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-
-        response = requests.post(url, json=api_kwargs, headers=headers)
-
-        json_response = response.json()
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.create_merchant.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return get_pipeline().send(HelcimRequest(
+            cls.create_merchant.__qualname__, 'POST', '/v2/customers/', account_id,
+            json=api_kwargs,
+        ))
 
     @classmethod
     def create_account_link(cls, account_id: str, **api_kwargs):
@@ -302,7 +234,7 @@ class HelcimMerchantClient(AbstractMerchantClient):
             account_corporate: BANK_ACCOUNT_CORPORATE = 'PERSONAL',
             **api_kwargs
     ):
-        api_kwargs = {
+        payload = {
             "bankData": {
                 "firstName": first_name,
                 "lastName": last_name,
@@ -318,72 +250,39 @@ class HelcimMerchantClient(AbstractMerchantClient):
                 "province": state,
                 "postalCode": postal_code
             },
-            "ipAddress": get_current_server(),
             "currency": currency,
             "amount": 0,
             "customerCode": helcim_customer_code
         }
-        if api_kwargs.get('ipAddress', None):
-            api_kwargs["ipAddress"] = api_kwargs["ipAddress"]
-        else:
-            api_kwargs["ipAddress"] = get_current_server()
         if company_name:
-            api_kwargs['bankData']['companyName'] = company_name
+            payload['bankData']['companyName'] = company_name
         else:
-            api_kwargs['bankData']['companyName'] = last_name
-
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        url = "https://api.helcim.com/v2/payment/withdraw"
-        response = requests.post(url, json=api_kwargs, headers=headers)
+            payload['bankData']['companyName'] = last_name
 
-        json_response = response.json()
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.create_bank_account.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return get_pipeline().send(HelcimRequest(
+            cls.create_bank_account.__qualname__, 'POST', '/v2/payment/withdraw', account_id,
+            json=payload, operation='create_bank_account', with_ip_address=True,
+            api_kwargs=api_kwargs,
+        ))
 
     @classmethod
     def get_customer_cards(cls, account_id: str, customer_id: str, **api_kwargs):
-
-        url = f"https://api.helcim.com/v2/customers/{customer_id}/cards"
-        headers = {
-            "accept": "application/json",
-            "api-token": f"{account_id}"
-        }
-
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        response = requests.get(url, headers=headers)
-        json_response = response.json()
-
-        if isinstance(json_response, dict) and json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.get_customer_cards.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-
-        else:
-            cards = list()
-            for item in json_response:
-                payment_method = {
-                    'funding_id': item['cardToken'],
-                    'last4': item['cardF6L4'][-4:],
-                    'exp_month': item['cardExpiry'][:2],
-                    'exp_year': item['cardExpiry'][2:],
-                    'brand': None,
-                }
-                cards.append(payment_method)
-            return cards
+        json_response = get_pipeline().send(HelcimRequest(
+            cls.get_customer_cards.__qualname__, 'GET', f'/v2/customers/{customer_id}/cards',
+            account_id,
+        ))
+
+        cards = list()
+        for item in json_response:
+            payment_method = {
+                'funding_id': item['cardToken'],
+                'last4': item['cardF6L4'][-4:],
+                'exp_month': item['cardExpiry'][:2],
+                'exp_year': item['cardExpiry'][2:],
+                'brand': None,
+            }
+            cards.append(payment_method)
+        return cards
 
     @classmethod
     def retrieve_merchant(cls, customer_id):
@@ -411,60 +310,33 @@ class HelcimPayment(AbstractPayment):
             currency: str = 'CAD',
             **api_kwargs
     ):
-        url = "https://api.helcim.com/v2/payment/purchase"
         payload = {
             "cardData": {"cardToken": funding_id},
             "currency": currency,
             "amount": str(amount),
             "customerCode": customer_code,
         }
-        if api_kwargs.get('ipAddress', None):
-            payload["ipAddress"] = api_kwargs["ipAddress"]
-        else:
-            payload["ipAddress"] = get_current_server()
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id,
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-        response = requests.post(url, json=payload, headers=headers)
-        json_response = response.json()
-        if json_response.get('errors', None):
-            logger.exception(
-                f'{error_logs_prefix} {cls.payment.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-            return {'status': 'ERROR'}
-        else:
-            return json_response
+        return get_pipeline().send(HelcimRequest(
+            cls.payment.__qualname__, 'POST', '/v2/payment/purchase', account_id,
+            json=payload, operation='payment', errors=LOG_ERRORS, with_ip_address=True,
+            api_kwargs=api_kwargs,
+        ))
 
     @classmethod
     def get_invoice_by_invoice_number(cls, account_id: str, invoice_number: str,):
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        url = f"https://api.helcim.com/v2/invoices/?invoiceNumber={invoice_number}"
-        response = requests.get(url, headers=headers)
-        invoice_data = response.json()[0]
+        json_response = get_pipeline().send(HelcimRequest(
+            cls.get_invoice_by_invoice_number.__qualname__, 'GET', '/v2/invoices/', account_id,
+            params={'invoiceNumber': invoice_number}, errors=IGNORE_ERRORS,
+        ))
+        invoice_data = json_response[0]
         return invoice_data
 
     @classmethod
     def get_invoice_by_invoice_id(cls, account_id: str, invoice_id: str,):
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        url = f"https://api.helcim.com/v2/invoices/{invoice_id}"
-        response = requests.get(url, headers=headers)
-        invoice_data = response.json()
+        invoice_data = get_pipeline().send(HelcimRequest(
+            cls.get_invoice_by_invoice_id.__qualname__, 'GET', f'/v2/invoices/{invoice_id}',
+            account_id, errors=IGNORE_ERRORS,
+        ))
         return invoice_data
 
     def initiate_payment(self):
@@ -481,37 +353,16 @@ class HelcimTransfer(AbstractTransfer):
 
     @classmethod
     def transfer(cls, account_id, helcim_customer_code, amount: float, bank_token: str, currency: str = 'CAD', **api_kwargs):
-        url = "https://api.helcim.com/v2/payment/withdraw"
-
         payload = {
             "bankData": {"bankToken": bank_token},
             "currency": currency,
             "amount": amount,
             "customerCode": helcim_customer_code,
         }
-        if api_kwargs.get('ipAddress', None):
-            payload["ipAddress"] = api_kwargs["ipAddress"]
-        else:
-            payload["ipAddress"] = get_current_server()
-        headers = {
-            "accept": "application/json",
-            "idempotency-key": str(uuid4())[:25],
-            "content-type": "application/json",
-            "api-token": account_id
-        }
-        if settings.HELCIM_PARTNER_TOKEN:
-            headers['partner-token'] = settings.HELCIM_PARTNER_TOKEN
-
-        response = requests.post(url, json=payload, headers=headers)
-        json_response = response.json()
-
-        if json_response.get('errors', None):
-            raise Exception(
-                f'{error_logs_prefix} {cls.transfer.__qualname__} '
-                f'{str(json_response["errors"])}'
-            )
-        else:
-            return json_response
+        return get_pipeline().send(HelcimRequest(
+            cls.transfer.__qualname__, 'POST', '/v2/payment/withdraw', account_id,
+            json=payload, operation='transfer', with_ip_address=True, api_kwargs=api_kwargs,
+        ))
 
     def initiate_transfer(self):
         pass
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_RATE = 10   # requests per second for each api-token
+DEFAULT_BURST = 20
+DEFAULT_PARTNER_RATE = None   # partner-token is not limited unless configured
+DEFAULT_PARTNER_BURST = 50
+# seconds a request may wait for a token, refused requests are retried by
+# RetryPolicy and waited out by HelcimBulkPayout, whose default pool keeps a
+# single api-token queue around half of this
+DEFAULT_MAX_QUEUE_WAIT = 2.0
+
+
+class HelcimRateLimitError(Exception):
+    """raised instead of waiting longer than max_queue_wait for a token"""
+
+    def __init__(self, wait, max_queue_wait):
+        self.wait = wait
+        self.max_queue_wait = max_queue_wait
+        super().__init__(
+            f'Helcim client side rate limit exceeded, a token is {wait:.2f}s away '
+            f'and requests wait at most {max_queue_wait:.2f}s'
+        )
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket
+
+    *** every acquire reserves one token, when the bucket is empty the
+    *** balance goes negative and the caller sleeps until its token has been
+    *** refilled, so concurrent callers are served in arrival order with a
+    *** single sleep each instead of polling.
+    *** a caller whose token is more than max_queue_wait seconds away gets
+    *** HelcimRateLimitError right away and reserves nothing, so a burst
+    *** can't hold request threads for minutes.
+
+    """
+
+    def __init__(self, rate, burst, max_queue_wait=None):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.max_queue_wait = max_queue_wait
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.rejected = 0
+
+    def _reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if self.max_queue_wait is not None and wait > self.max_queue_wait:
+                self.rejected += 1
+                raise HelcimRateLimitError(wait, self.max_queue_wait)
+            self.tokens -= 1
+            self.requests += 1
+            if wait:
+                self.throttled += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def acquire(self):
+        """
+        blocks until a token is available, returns the seconds spent waiting,
+        raises HelcimRateLimitError when that would be longer than max_queue_wait
+        """
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'burst': self.capacity,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'avg_wait': self.total_wait / self.requests if self.requests else 0.0,
+            }
+
+
+class HelcimRateLimiter:
+    """
+    Client-side rate limiter for Helcim api calls
+
+    *** one TokenBucket per api-token and one per partner-token, a request
+    *** has to get a token from both before it is sent. buckets and metrics
+    *** are keyed by a hash of the token so secrets never end up in logs.
+
+    """
+
+    def __init__(self, rate=None, burst=None, partner_rate=None, partner_burst=None,
+                 max_queue_wait=None):
+        self.rate = rate if rate is not None else getattr(
+            settings, 'HELCIM_RATE_LIMIT', DEFAULT_RATE)
+        self.burst = burst or getattr(settings, 'HELCIM_RATE_BURST', DEFAULT_BURST)
+        self.partner_rate = partner_rate if partner_rate is not None else getattr(
+            settings, 'HELCIM_PARTNER_RATE_LIMIT', DEFAULT_PARTNER_RATE)
+        self.partner_burst = partner_burst or getattr(
+            settings, 'HELCIM_PARTNER_RATE_BURST', DEFAULT_PARTNER_BURST)
+        self.max_queue_wait = max_queue_wait if max_queue_wait is not None else getattr(
+            settings, 'HELCIM_RATE_LIMIT_MAX_WAIT', DEFAULT_MAX_QUEUE_WAIT)
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def token_key(kind, token):
+        return f'{kind}:{hashlib.sha256(str(token).encode()).hexdigest()[:12]}'
+
+    def get_bucket(self, kind, token, rate, burst):
+        key = self.token_key(kind, token)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.setdefault(
+                    key, TokenBucket(rate, burst, self.max_queue_wait))
+        return bucket
+
+    def acquire(self, headers):
+        """waits for the api-token and partner-token buckets of these headers"""
+        if not headers:
+            return 0.0
+        wait = 0.0
+        if self.partner_rate and headers.get('partner-token'):
+            wait += self.get_bucket(
+                'partner', headers['partner-token'], self.partner_rate, self.partner_burst
+            ).acquire()
+        if self.rate and headers.get('api-token'):
+            wait += self.get_bucket(
+                'api', headers['api-token'], self.rate, self.burst
+            ).acquire()
+        if wait:
+            logger.debug(f'Helcim request throttled client side for {wait:.3f}s')
+        return wait
+
+    def metrics(self):
+        """returns queue wait metrics for every bucket"""
+        with self.lock:
+            buckets = dict(self.buckets)
+        return {key: bucket.metrics() for key, bucket in buckets.items()}
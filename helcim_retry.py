@@ -0,0 +1,154 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+from uuid import uuid4
+
+import requests
+
+from django.conf import settings
+
+from helcim_breaker import HelcimCircuitOpenError
+from helcim_rate_limit import HelcimRateLimitError
+
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 0.25   # seconds
+DEFAULT_MAX_DELAY = 5.0
+DEFAULT_BUDGET_RATIO = 0.2   # retries allowed per request sent
+DEFAULT_BUDGET_BURST = 10   # retries that can be spent at once
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENCY_KEY_LENGTH = 25
+
+
+def idempotency_key(account_id, operation, api_kwargs=None):
+    """
+    returns the idempotency-key of a Helcim write
+
+    *** an explicit `idempotency_key` kwarg is used as is, an `operation_id`
+    *** kwarg (e.g. installment or transaction id) is hashed together with the
+    *** account and operation so every process derives the same key for the
+    *** same logical operation, otherwise a random key is generated for this
+    *** call and reused by all of its retries.
+    """
+    api_kwargs = api_kwargs or dict()
+    if api_kwargs.get('idempotency_key', None):
+        return str(api_kwargs['idempotency_key'])
+    if api_kwargs.get('operation_id', None) is not None:
+        digest = hashlib.sha256(
+            f'{account_id}:{operation}:{api_kwargs["operation_id"]}'.encode()
+        ).hexdigest()
+        return digest[:IDEMPOTENCY_KEY_LENGTH]
+    return str(uuid4())[:IDEMPOTENCY_KEY_LENGTH]
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the traffic
+
+    *** every request deposits `ratio` tokens and every retry withdraws one,
+    *** so an outage can't multiply the load on Helcim by max_attempts.
+
+    """
+
+    def __init__(self, ratio=None, burst=None):
+        self.ratio = ratio if ratio is not None else getattr(
+            settings, 'HELCIM_RETRY_BUDGET_RATIO', DEFAULT_BUDGET_RATIO)
+        self.burst = burst if burst is not None else getattr(
+            settings, 'HELCIM_RETRY_BUDGET_BURST', DEFAULT_BUDGET_BURST)
+        self.balance = float(self.burst)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.balance + self.ratio, self.burst)
+
+    def withdraw(self):
+        with self.lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for Helcim requests
+
+    *** only requests that are safe to repeat are retried: GETs and writes
+    *** carrying an idempotency-key, so a retried charge reuses its key and
+    *** Helcim returns the original result instead of charging again.
+    *** a request refused by the client side rate limiter was never sent, so
+    *** it is retried whatever its method once its token is within reach.
+
+    """
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None, budget=None):
+        self.max_attempts = max_attempts or getattr(
+            settings, 'HELCIM_RETRY_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.base_delay = base_delay if base_delay is not None else getattr(
+            settings, 'HELCIM_RETRY_BASE_DELAY', DEFAULT_BASE_DELAY)
+        self.max_delay = max_delay if max_delay is not None else getattr(
+            settings, 'HELCIM_RETRY_MAX_DELAY', DEFAULT_MAX_DELAY)
+        self.budget = budget or RetryBudget()
+
+    @staticmethod
+    def is_repeatable(method, headers):
+        return method == 'GET' or bool(headers and headers.get('idempotency-key'))
+
+    def can_retry(self, repeatable, attempt):
+        return repeatable and attempt + 1 < self.max_attempts and self.budget.withdraw()
+
+    def backoff(self, attempt, response=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.max_delay))
+            except ValueError:
+                pass
+        return delay
+
+    def call(self, send, method, url, **kwargs):
+        """calls send(method, url, **kwargs) and retries transient failures"""
+        self.budget.deposit()
+        repeatable = self.is_repeatable(method, kwargs.get('headers'))
+        attempt = 0
+        sent = False
+        while True:
+            response = None
+            min_delay = 0.0
+            try:
+                response = send(method, url, **kwargs)
+                sent = True
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+                failure = f'status {response.status_code}'
+            except HelcimRateLimitError as e:
+                failure = str(e)
+                if not self.can_retry(True, attempt):
+                    raise
+                min_delay = e.wait - e.max_queue_wait
+            except HelcimCircuitOpenError as e:
+                # refused before any attempt went out: nothing of this call was sent
+                e.request_sent = sent
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                sent = True
+                failure = str(e)
+                if not self.can_retry(repeatable, attempt):
+                    raise
+            else:
+                if not self.can_retry(repeatable, attempt):
+                    return response
+            delay = max(self.backoff(attempt, response), min_delay)
+            attempt += 1
+            logger.warning(
+                f'Helcim {method} {url} failed ({failure}), '
+                f'retry {attempt} of {self.max_attempts - 1} in {delay:.2f}s'
+            )
+            time.sleep(delay)
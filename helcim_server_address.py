@@ -0,0 +1,91 @@
+import logging
+import signal
+import threading
+import time
+
+from django.conf import settings
+from payment.utils import get_current_server
+
+
+logger = logging.getLogger(__file__)
+
+error_logs_prefix = 'Payment Package error in:'
+
+DEFAULT_SERVER_ADDRESS_REFRESH = 15 * 60   # seconds
+
+
+class ServerAddress:
+    """
+    Cached ip address of this server, sent as ipAddress of Helcim payments
+
+    *** resolved once, the first time it is needed or with resolve() at startup,
+    *** afterwards get() only reads an attribute.
+    *** once refresh_interval has passed get() still returns the current value
+    *** and re-resolves in a background thread, refresh() re-resolves right away
+    *** and install_signal_handler() lets e.g. `kill -HUP` do the same.
+    *** a failed refresh keeps the previous address.
+
+    """
+
+    def __init__(self, resolver=get_current_server, refresh_interval=None):
+        self.resolver = resolver
+        self.refresh_interval = refresh_interval or getattr(
+            settings, 'HELCIM_SERVER_ADDRESS_REFRESH', DEFAULT_SERVER_ADDRESS_REFRESH)
+        self.value = None
+        self.expires_at = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.value is None:
+            return self.resolve()
+        if self.expires_at < time.monotonic() and not self.refreshing:
+            self.refresh_in_background()
+        return self.value
+
+    def resolve(self):
+        """resolves the address now unless another thread already did"""
+        with self.lock:
+            if self.value is None:
+                self._update()
+            return self.value
+
+    def refresh(self):
+        with self.lock:
+            self._update()
+            return self.value
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._refresh_and_release, daemon=True).start()
+
+    def install_signal_handler(self, signum=signal.SIGHUP):
+        """must be called from the main thread, the handler only schedules a refresh"""
+        signal.signal(signum, lambda signum, frame: self.refresh_in_background())
+
+    def _refresh_and_release(self):
+        try:
+            self.refresh()
+        finally:
+            self.refreshing = False
+
+    def _update(self):
+        try:
+            value = self.resolver()
+        except Exception as e:
+            logger.error(f'{error_logs_prefix} {self.refresh.__qualname__} {str(e)}')
+            value = None
+        if value:
+            self.value = value
+        # retry a failed resolution on the next interval as well
+        self.expires_at = time.monotonic() + self.refresh_interval
+
+
+server_address = ServerAddress()
+
+
+def get_server_address():
+    return server_address.get()
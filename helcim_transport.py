@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from helcim_breaker import CircuitBreakerRegistry
+from helcim_rate_limit import HelcimRateLimiter
+
+
+logger = logging.getLogger(__file__)
+
+HELCIM_API_URL = 'https://api.helcim.com'
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 20
+DEFAULT_POOL_BLOCK = False
+DEFAULT_CONNECT_TIMEOUT = 3.05   # seconds
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_ASYNC_CONCURRENCY = 20
+
+
+class HelcimTransport:
+    """
+    Process-wide pooled HTTP transport for Helcim api calls
+
+    *** every Helcim provider method routes through one shared session so
+    *** TCP and TLS connections to api.helcim.com are kept alive and reused
+    *** instead of being opened again for every call.
+    *** the session never stores cookies, the only state shared between
+    *** threads is the urllib3 connection pool which is thread-safe.
+    *** every request first waits on the per api-token rate limiter so
+    *** parallel callers stay under the provider side throttling.
+    *** every attempt has connect and read timeouts and goes through the
+    *** circuit breaker of its endpoint, so a degraded Helcim fails fast
+    *** with HelcimCircuitOpenError instead of holding workers.
+
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, pool_block=None,
+                 rate_limiter=None, breakers=None, timeout=None):
+        self.pool_connections = pool_connections or getattr(
+            settings, 'HELCIM_POOL_CONNECTIONS', DEFAULT_POOL_CONNECTIONS)
+        self.pool_maxsize = pool_maxsize or getattr(
+            settings, 'HELCIM_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE)
+        if pool_block is None:
+            pool_block = getattr(settings, 'HELCIM_POOL_BLOCK', DEFAULT_POOL_BLOCK)
+        self.pool_block = pool_block
+        self.session = self._build_session()
+        self.rate_limiter = rate_limiter or HelcimRateLimiter()
+        self.breakers = breakers or CircuitBreakerRegistry()
+        self.timeout = timeout or (
+            getattr(settings, 'HELCIM_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+            getattr(settings, 'HELCIM_READ_TIMEOUT', DEFAULT_READ_TIMEOUT),
+        )
+
+    def _build_session(self):
+        """
+        pool_connections is the number of hosts kept in the pool and
+        pool_maxsize the number of keep-alive connections per host
+        """
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.headers['Connection'] = 'keep-alive'
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            max_retries=0,
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @classmethod
+    def instance(cls):
+        """returns the process-wide transport, creating it on first use"""
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        """replaces the process-wide transport with a newly configured one"""
+        with cls._lock:
+            previous = cls._instance
+            cls._instance = cls(**kwargs)
+        if previous is not None:
+            previous.close()
+        return cls._instance
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = self.timeout
+        # wait for the rate limiter first, a request it rejects must not take
+        # a half-open trial call of the breaker
+        self.rate_limiter.acquire(kwargs.get('headers'))
+        breaker = self.breakers.get(method, url)
+        breaker.before_call()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.cancel_call()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_transport():
+    return HelcimTransport.instance()
+
+
+class AsyncHelcimTransport:
+    """
+    asyncio front end of HelcimTransport
+
+    *** requests are run on a dedicated thread pool against the shared
+    *** pooled session, a semaphore bounds how many of them are in flight
+    *** so fan-outs over hundreds of customers never exceed the pool size.
+
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, max_concurrency=None, transport=None):
+        self.max_concurrency = max_concurrency or getattr(
+            settings, 'HELCIM_ASYNC_CONCURRENCY', DEFAULT_ASYNC_CONCURRENCY)
+        self.transport = transport
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix='helcim')
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def instance(cls):
+        """returns the process-wide async transport, creating it on first use"""
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def _get_semaphore(self):
+        """asyncio semaphores are bound to a loop, so keep one per running loop"""
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores.setdefault(
+                loop, asyncio.Semaphore(self.max_concurrency))
+        return semaphore
+
+    async def run(self, func, *args):
+        """runs a blocking Helcim call, e.g. HelcimRequestPipeline.send, on the pool"""
+        loop = asyncio.get_running_loop()
+        async with self._get_semaphore():
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def request(self, method, url, **kwargs):
+        transport = self.transport or get_transport()
+        return await self.run(lambda: transport.request(method, url, **kwargs))
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def get_async_transport():
+    return AsyncHelcimTransport.instance()
@@ -0,0 +1,91 @@
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+logger = logging.getLogger(__file__)
+
+_current_identity_map = ContextVar('payment_identity_map', default=None)
+
+
+class IdentityMap:
+    """
+    Request or unit-of-work scoped map of the rows already loaded
+
+    *** inside `with identity_map():` get_object() loads every row at most
+    *** once, a repeated lookup with the same arguments or the same pk returns
+    *** the instance loaded first, so controllers share it and see each
+    *** other's changes.
+    *** `queries` and `hits` count lookups per model name for query-count
+    *** assertions, e.g. imap.queries['Client'] == 1.
+    *** outside of the block get_object() is a plain objects.get().
+
+    """
+
+    def __init__(self):
+        self.objects = dict()
+        self.queries = Counter()
+        self.hits = Counter()
+
+    @staticmethod
+    def key(model, lookup):
+        lookup = {('pk' if field == 'id' else field): value for field, value in lookup.items()}
+        return (model, tuple(sorted(lookup.items())))
+
+    def get(self, model, **lookup):
+        try:
+            key = self.key(model, lookup)
+            hash(key)
+        except TypeError:
+            # e.g. an unsaved instance in the lookup, can't be mapped
+            self.queries[model.__name__] += 1
+            return model.objects.get(**lookup)
+
+        obj = self.objects.get(key)
+        if obj is not None:
+            self.hits[model.__name__] += 1
+            return obj
+
+        self.queries[model.__name__] += 1
+        obj = model.objects.get(**lookup)
+        # later lookups of the same row by pk get the same instance
+        obj = self.objects.setdefault(self.key(model, {'pk': obj.pk}), obj)
+        self.objects[key] = obj
+        return obj
+
+    def add(self, obj):
+        """registers an instance that was loaded or created elsewhere"""
+        self.objects.setdefault(self.key(type(obj), {'pk': obj.pk}), obj)
+        return obj
+
+    def clear(self):
+        self.objects.clear()
+
+
+@contextmanager
+def identity_map():
+    """activates an IdentityMap for the block, nested blocks reuse the outer one"""
+    current = _current_identity_map.get()
+    if current is not None:
+        yield current
+        return
+    imap = IdentityMap()
+    token = _current_identity_map.set(imap)
+    try:
+        yield imap
+    finally:
+        _current_identity_map.reset(token)
+
+
+def get_identity_map():
+    """returns the active IdentityMap or None"""
+    return _current_identity_map.get()
+
+
+def get_object(model, **lookup):
+    """model.objects.get(**lookup) that goes through the active IdentityMap"""
+    imap = _current_identity_map.get()
+    if imap is None:
+        return model.objects.get(**lookup)
+    return imap.get(model, **lookup)
@@ -0,0 +1,88 @@
+import importlib
+import logging
+import threading
+
+
+logger = logging.getLogger(__file__)
+
+# provider name -> module of .payment_providers implementing it
+PROVIDER_MODULES = {
+    'dwolla': ('dwolla_provider',),
+    'dwolla+plaid': ('dwolla_provider', 'plaid_provider'),
+    'stripe': ('stripe_provider',),
+    'plaid': ('plaid_provider',),
+}
+
+
+class LazyProviderModule:
+    """
+    Stand-in for a payment_providers module that imports it on first use
+
+    *** `dwolla_provider.DwollaTransfer()` works as with the real module, but
+    *** the module, and the provider sdk it imports, is only loaded the first
+    *** time an attribute is read, so deployments only pay for the provider
+    *** they actually use.
+
+    """
+
+    def __init__(self, module_name, package=__package__):
+        self._module_name = module_name
+        self._package = package
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(
+                        f'.payment_providers.{self._module_name}', self._package)
+                    logger.debug(f'payment provider module {self._module_name} loaded')
+        return self._module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, name):
+        # only called for attributes missing on the proxy itself
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        state = 'loaded' if self.is_loaded else 'not loaded'
+        return f'<LazyProviderModule {self._module_name} ({state})>'
+
+
+class ProviderModuleRegistry:
+    """keeps one LazyProviderModule per module name"""
+
+    def __init__(self):
+        self.modules = dict()
+        self.lock = threading.Lock()
+
+    def module(self, module_name):
+        module = self.modules.get(module_name)
+        if module is None:
+            with self.lock:
+                module = self.modules.setdefault(module_name, LazyProviderModule(module_name))
+        return module
+
+    def modules_of(self, provider):
+        return [self.module(module_name) for module_name in PROVIDER_MODULES.get(provider, ())]
+
+    def preload(self, provider):
+        """imports the modules of a provider up front, e.g. from AppConfig.ready()"""
+        for module in self.modules_of(provider):
+            module.load()
+
+    def loaded(self):
+        return [name for name, module in self.modules.items() if module.is_loaded]
+
+
+provider_modules = ProviderModuleRegistry()
+
+
+def lazy_provider_module(module_name):
+    return provider_modules.module(module_name)
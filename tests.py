@@ -1,20 +1,115 @@
+import random
+import threading
+import time
 
-def test_helcim_factory():
+import requests
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from cache_utils import TTLCache
+from factory import HelcimFactory, RoutingFactory
+from helcim_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreakerRegistry, HelcimCircuitOpenError
+import helcim_cache
+import helcim_payouts
+import helcim_pipeline
+from helcim_pipeline import (
+    AuthHeadersStage, DecodeStage, HelcimRequest, HelcimRequestPipeline, IdempotencyStage, RetryStage)
+from helcim_provider import HelcimClinet, HelcimPayment
+from helcim_rate_limit import HelcimRateLimitError, HelcimRateLimiter, TokenBucket
+from helcim_retry import RetryBudget, RetryPolicy, idempotency_key
+from helcim_server_address import ServerAddress
+from helcim_transport import HelcimTransport
+from identity_map import get_identity_map, get_object, identity_map
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, json_data=None, headers=None):
+        self.status_code = status_code
+        self.json_data = json_data if json_data is not None else dict()
+        self.headers = headers or dict()
+
+    def json(self):
+        return self.json_data
+
+
+class FakeSession:
+    """
+    stands in for the requests session of HelcimTransport
+
+    *** every request pops the next item of responses: a FakeResponse is
+    *** returned, an exception is raised and a callable is called first.
+    *** the method, url and headers of every request are kept in calls and
+    *** their json body in payloads.
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.payloads = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.calls.append((method, url, dict(kwargs.get('headers') or dict())))
+            self.payloads.append(kwargs.get('json'))
+            response = self.responses.pop(0)
+        if callable(response):
+            response = response()
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+def fake_transport(session, rate_limiter=None, **breaker_kwargs):
+    """a transport sending through session, without rate limiting by default"""
+    transport = HelcimTransport(
+        rate_limiter=rate_limiter or HelcimRateLimiter(rate=0),
+        breakers=CircuitBreakerRegistry(**breaker_kwargs))
+    transport.session = session
+    return transport
+
+
+def fake_pipeline(monkeypatch, transport, retry_policy=None):
+    """makes get_pipeline() send through transport for the duration of a test"""
+    pipeline = HelcimRequestPipeline(transport=transport)
+    if retry_policy is not None:
+        pipeline.get_stage(RetryStage).retry_policy = retry_policy
+    monkeypatch.setattr(HelcimRequestPipeline, '_instance', pipeline)
+    return pipeline
+
+
+PURCHASE_URL = 'https://api.helcim.com/v2/payment/purchase'
+
+
+def test_helcim_factory(monkeypatch):
+    session = FakeSession(
+        FakeResponse(200, {'customerCode': 'CST1001'}), FakeResponse(200, {'customerCode': 'CST1002'}))
+    fake_pipeline(monkeypatch, fake_transport(session))
     factory = HelcimFactory()
 
     # Test Customer Client
     customer_client = factory.create_customer_client()
-    customer_client.create_customer(name="John Doe")
-    customer_client.retrieve_customer(customer_id="12345")
-    customer_client.update_customer(customer_id="12345", name="Jane Doe")
-    customer_client.delete_customer(customer_id="12345")
+    assert customer_client.create_customer('account', first_name="John", last_name="Doe") == \
+        {'customerCode': 'CST1001'}
+    customer_client.retrieve_customer("12345")
+    customer_client.update_customer("12345")
+    customer_client.delete_customer("12345")
 
     # Test Merchant Client
     merchant_client = factory.create_merchant_client()
-    merchant_client.create_merchant(name="Doe Enterprises")
-    merchant_client.retrieve_merchant(merchant_id="67890")
-    merchant_client.update_merchant(merchant_id="67890", name="Doe Enterprises Inc.")
-    merchant_client.delete_merchant(merchant_id="67890")
+    assert merchant_client.create_merchant('account', last_name="Doe Enterprises") == \
+        {'customerCode': 'CST1002'}
+    merchant_client.retrieve_merchant("67890")
+    merchant_client.update_merchant("67890")
+    merchant_client.delete_merchant("67890")
+
+    assert [payload['contactName'] for payload in session.payloads] == ['John Doe', 'Doe Enterprises']
+    assert all(headers['api-token'] == 'account' for _, _, headers in session.calls)
 
     # Test Single Payment Strategy
     single_payment_strategy = factory.create_single_payment_strategy()
@@ -42,5 +137,590 @@ def test_helcim_factory():
     recurring_transfer_strategy.cancel_transfer(transfer_id="rec_trans_001")
 
 
-# Run the test
-test_helcim_factory()
+def test_circuit_breaker_recovers_through_half_open():
+    transport = fake_transport(
+        FakeSession(), failure_threshold=2, recovery_timeout=0.05, half_open_calls=1)
+    breaker = transport.breakers.get('POST', PURCHASE_URL)
+
+    def trial_call():
+        assert breaker.state == HALF_OPEN
+        # only one trial call is let through while half open
+        try:
+            breaker.before_call()
+            assert False, 'second trial call went through'
+        except HelcimCircuitOpenError:
+            pass
+        return FakeResponse(200)
+
+    transport.session.responses = [FakeResponse(500), FakeResponse(500), trial_call]
+
+    assert transport.post(PURCHASE_URL).status_code == 500
+    assert breaker.state == CLOSED
+    assert transport.post(PURCHASE_URL).status_code == 500
+    assert breaker.state == OPEN and breaker.is_open()
+
+    try:
+        transport.post(PURCHASE_URL)
+        assert False, 'open breaker let a request through'
+    except HelcimCircuitOpenError as e:
+        assert e.endpoint == 'POST /v2/payment/purchase'
+    assert len(transport.session.calls) == 2
+
+    time.sleep(0.06)
+    assert transport.post(PURCHASE_URL).status_code == 200
+    assert breaker.state == CLOSED and breaker.failures == 0
+    assert len(transport.session.calls) == 3
+
+
+class Interrupted(BaseException):
+    """like gevent's Timeout, not an Exception"""
+
+
+def test_circuit_breaker_survives_interrupted_trial():
+    transport = fake_transport(
+        FakeSession(FakeResponse(500), Interrupted(), FakeResponse(200)),
+        failure_threshold=1, recovery_timeout=0.05)
+    breaker = transport.breakers.get('POST', PURCHASE_URL)
+
+    transport.post(PURCHASE_URL)
+    time.sleep(0.06)
+    try:
+        transport.post(PURCHASE_URL)
+        assert False, 'interruption was swallowed'
+    except Interrupted:
+        pass
+    # the interrupted trial gave its slot back
+    assert breaker.state == HALF_OPEN and breaker.trial_calls == 0
+    assert transport.post(PURCHASE_URL).status_code == 200
+    assert breaker.state == CLOSED
+
+
+def test_circuit_breaker_reopens_on_failed_trial():
+    transport = fake_transport(
+        FakeSession(FakeResponse(503), requests.ConnectionError('reset')),
+        failure_threshold=1, recovery_timeout=0.05)
+    breaker = transport.breakers.get('POST', PURCHASE_URL)
+
+    transport.post(PURCHASE_URL)
+    assert breaker.state == OPEN
+    time.sleep(0.06)
+    try:
+        transport.post(PURCHASE_URL)
+        assert False, 'connection error was swallowed'
+    except requests.ConnectionError:
+        pass
+    assert breaker.state == OPEN and breaker.is_open()
+
+
+def test_retry_reuses_idempotency_key():
+    session = FakeSession(
+        FakeResponse(503), requests.ConnectionError('reset'), FakeResponse(200, {'transactionId': 7}))
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0, budget=RetryBudget(ratio=0, burst=10))
+    pipeline = HelcimRequestPipeline(
+        stages=[AuthHeadersStage(), IdempotencyStage(), DecodeStage(), RetryStage(retry_policy)],
+        transport=fake_transport(session),
+    )
+    request = HelcimRequest(
+        'test', 'POST', '/v2/payment/purchase', 'account', json={'amount': 1},
+        operation='purchase', api_kwargs={'operation_id': 42})
+
+    assert pipeline.send(request) == {'transactionId': 7}
+    keys = [headers['idempotency-key'] for _, _, headers in session.calls]
+    assert len(keys) == 3
+    assert set(keys) == {idempotency_key('account', 'purchase', {'operation_id': 42})}
+    assert retry_policy.budget.balance == 8
+
+
+def test_retry_stops_when_budget_is_spent():
+    session = FakeSession(*[FakeResponse(503) for _ in range(3)])
+    transport = fake_transport(session)
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0, budget=RetryBudget(ratio=0, burst=1))
+    headers = {'idempotency-key': 'key'}
+
+    # the only token of the budget pays for one retry, then the 503 is returned
+    assert retry_policy.call(transport.request, 'POST', PURCHASE_URL, headers=headers).status_code == 503
+    assert len(session.calls) == 2
+    assert retry_policy.budget.balance == 0
+
+    assert retry_policy.call(transport.request, 'POST', PURCHASE_URL, headers=headers).status_code == 503
+    assert len(session.calls) == 3
+
+
+def test_retry_waits_out_client_side_rate_limit():
+    session = FakeSession(FakeResponse(200), FakeResponse(200))
+    rate_limiter = HelcimRateLimiter(rate=50, burst=1, max_queue_wait=0.001)
+    transport = fake_transport(session, rate_limiter=rate_limiter)
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0, budget=RetryBudget(ratio=0, burst=10))
+
+    # writes without an idempotency-key are retried too, nothing was sent
+    for _ in range(2):
+        response = retry_policy.call(
+            transport.request, 'POST', PURCHASE_URL, headers={'api-token': 'account'})
+        assert response.status_code == 200
+
+    assert len(session.calls) == 2
+    (bucket_metrics,) = rate_limiter.metrics().values()
+    assert bucket_metrics['rejected'] >= 1
+    assert retry_policy.budget.balance == 10 - bucket_metrics['rejected']
+
+
+def test_retry_gives_up_on_rate_limit_when_budget_is_spent():
+    transport = fake_transport(
+        FakeSession(FakeResponse(200)), rate_limiter=HelcimRateLimiter(rate=1, burst=1, max_queue_wait=0.001))
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0, budget=RetryBudget(ratio=0, burst=0))
+
+    transport.request('GET', PURCHASE_URL, headers={'api-token': 'account'})
+    try:
+        retry_policy.call(transport.request, 'GET', PURCHASE_URL, headers={'api-token': 'account'})
+        assert False, 'rate limited request went through'
+    except HelcimRateLimitError:
+        pass
+
+
+def test_retry_skips_writes_without_idempotency_key():
+    session = FakeSession(FakeResponse(503))
+    retry_policy = RetryPolicy(max_attempts=3, base_delay=0, budget=RetryBudget(ratio=0, burst=10))
+
+    response = retry_policy.call(fake_transport(session).request, 'POST', PURCHASE_URL, headers={})
+    assert response.status_code == 503
+    assert len(session.calls) == 1
+    assert retry_policy.budget.balance == 10
+
+
+def test_token_bucket_wait_metrics():
+    bucket = TokenBucket(rate=10, burst=1, max_queue_wait=1)
+
+    assert bucket.acquire() == 0.0
+    wait = bucket.acquire()
+    assert 0 < wait <= 0.1
+
+    metrics = bucket.metrics()
+    assert metrics['requests'] == 2
+    assert metrics['throttled'] == 1
+    assert metrics['rejected'] == 0
+    assert metrics['max_wait'] == metrics['total_wait'] == wait
+    assert metrics['avg_wait'] == wait / 2
+
+
+def test_token_bucket_rejects_long_waits():
+    bucket = TokenBucket(rate=1, burst=1, max_queue_wait=0.1)
+    bucket.acquire()
+
+    start = time.monotonic()
+    try:
+        bucket.acquire()
+        assert False, 'waited longer than max_queue_wait'
+    except HelcimRateLimitError as e:
+        assert e.wait > e.max_queue_wait == 0.1
+    assert time.monotonic() - start < 0.1
+
+    metrics = bucket.metrics()
+    assert metrics['requests'] == 1 and metrics['rejected'] == 1
+    # a rejected request reserves nothing
+    assert 0 <= bucket.tokens < 1
+
+
+def test_rate_limiter_metrics_hide_tokens():
+    rate_limiter = HelcimRateLimiter(rate=100, burst=1, max_queue_wait=1)
+    rate_limiter.acquire({'api-token': 'secret-token'})
+    rate_limiter.acquire({'api-token': 'secret-token'})
+
+    metrics = rate_limiter.metrics()
+    assert len(metrics) == 1
+    key, bucket_metrics = metrics.popitem()
+    assert key.startswith('api:') and 'secret-token' not in key
+    assert bucket_metrics['requests'] == 2 and bucket_metrics['throttled'] == 1
+
+
+def test_bulk_payout_keeps_lane_order(monkeypatch):
+    sent = []
+    lock = threading.Lock()
+
+    def transfer(account_id, customer_code, amount, bank_token, currency='CAD', **api_kwargs):
+        time.sleep(random.uniform(0, 0.005))
+        with lock:
+            sent.append((account_id, customer_code, amount, api_kwargs.get('operation_id')))
+        if amount == 13:
+            raise ValueError('declined')
+        return {'amount': amount}
+
+    monkeypatch.setattr(helcim_payouts.HelcimTransfer, 'transfer', staticmethod(transfer))
+    rows = [
+        helcim_payouts.PayoutRow('account', customer_code, index, 'token', f'payout-{index}')
+        for index, customer_code in enumerate(['a', 'b', 'c'] * 10)
+    ]
+
+    results = list(helcim_payouts.bulk_transfer(rows, max_workers=3))
+
+    assert sorted(result.index for result in results) == list(range(len(rows)))
+    for customer_code in ('a', 'b', 'c'):
+        lane = [amount for _, code, amount, _ in sent if code == customer_code]
+        assert lane == [row.amount for row in rows if row.customer_code == customer_code]
+    assert {operation_id for *_, operation_id in sent} == {row.operation_id for row in rows}
+    failed = [result for result in results if result.error is not None]
+    assert len(failed) == 1 and failed[0].row.amount == 13
+
+
+def test_bulk_payout_waits_for_rate_limiter(monkeypatch):
+    rows = [
+        helcim_payouts.PayoutRow('account', customer_code, index, 'token', f'payout-{index}')
+        for index, customer_code in enumerate([f'customer-{number}' for number in range(20)] * 3)
+    ]
+    session = FakeSession(*[FakeResponse(200, {'transactionId': index}) for index in range(len(rows))])
+    rate_limiter = HelcimRateLimiter(rate=200, burst=2, max_queue_wait=0.02)
+    # without retries every refused request reaches the payout engine
+    fake_pipeline(
+        monkeypatch, fake_transport(session, rate_limiter=rate_limiter),
+        RetryPolicy(max_attempts=1, budget=RetryBudget(ratio=0, burst=0)),
+    )
+
+    results = list(helcim_payouts.bulk_transfer(rows, max_workers=30, ipAddress='1.2.3.4'))
+
+    assert [result.error for result in results] == [None] * len(rows)
+    assert len(session.calls) == len(rows)
+    (bucket_metrics,) = rate_limiter.metrics().values()
+    assert bucket_metrics['rejected'] > 0
+    for customer_code in {row.customer_code for row in rows}:
+        lane = [payload['amount'] for payload in session.payloads
+                if payload['customerCode'] == customer_code]
+        assert lane == [row.amount for row in rows if row.customer_code == customer_code]
+
+
+def test_bulk_payout_rejects_shared_idempotency_key():
+    for name in ('idempotency_key', 'operation_id'):
+        try:
+            helcim_payouts.HelcimBulkPayout(**{name: 'run-1'})
+            assert False, f'{name} was shared by every payout'
+        except ValueError:
+            pass
+
+
+class FakePaymentFactory:
+    """
+    factory of a provider whose single payments are sent through transport,
+    with the retries and the unavailable-error check of HelcimFactory
+    """
+    is_unavailable_error = staticmethod(HelcimFactory.is_unavailable_error)
+    is_failed_result = staticmethod(HelcimFactory.is_failed_result)
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.retry_policy = RetryPolicy(
+            max_attempts=3, base_delay=0, budget=RetryBudget(ratio=0, burst=10))
+
+    def create_single_payment_strategy(self, *args, **kwargs):
+        return FakePaymentStrategy(self)
+
+
+class FakePaymentStrategy:
+    def __init__(self, factory):
+        self.factory = factory
+
+    def initiate_payment(self, amount):
+        return self.factory.retry_policy.call(
+            self.factory.transport.request, 'POST', PURCHASE_URL,
+            headers={'idempotency-key': f'payment-{amount}'}, json={'amount': amount}
+        ).json()
+
+    def retrieve_payment(self, payment_id):
+        return self.factory.transport.get(f'{PURCHASE_URL}/{payment_id}').json()
+
+
+def test_routing_fails_over_when_breaker_refused_first_attempt():
+    primary_session = FakeSession(FakeResponse(503))
+    primary = FakePaymentFactory(fake_transport(primary_session, failure_threshold=1))
+    fallback_session = FakeSession(
+        FakeResponse(200, {'transactionId': 1}), FakeResponse(200, {'transactionId': 1}))
+    fallback = FakePaymentFactory(fake_transport(fallback_session))
+
+    # the 503 opens the breaker, its retry is refused after a request was sent,
+    # so the payment may have gone through and must not be sent elsewhere
+    router = RoutingFactory({'primary': primary, 'fallback': fallback})
+    try:
+        router.call('merchant', 'initiate_payment', 10)
+        assert False, 'payment was sent to a second provider'
+    except HelcimCircuitOpenError as e:
+        assert e.request_sent
+    assert fallback_session.calls == []
+    assert router.metrics()['primary']['error_rate'] > 0
+
+    # now the breaker refuses the first attempt, nothing reached the primary
+    router = RoutingFactory({'primary': primary, 'fallback': fallback})
+    strategy = router.create_single_payment_strategy(account_id='merchant')
+    assert strategy.initiate_payment(20) == {'transactionId': 1}
+    assert strategy.last_provider() == 'fallback'
+    assert len(primary_session.calls) == 1
+    assert fallback_session.calls[0][2]['idempotency-key'] == 'payment-20'
+    assert strategy.retrieve_payment(1) == {'transactionId': 1}
+    assert len(fallback_session.calls) == 2
+
+
+def test_routing_honours_merchant_constraints():
+    primary_session = FakeSession(FakeResponse(200, {'transactionId': 1}))
+    fallback_session = FakeSession(FakeResponse(200, {'transactionId': 2}))
+    router = RoutingFactory(
+        {'primary': FakePaymentFactory(fake_transport(primary_session)),
+         'fallback': FakePaymentFactory(fake_transport(fallback_session))},
+        constraints={'merchant': ['fallback']},
+    )
+
+    assert router.call('merchant', 'initiate_payment', 10) == ('fallback', {'transactionId': 2})
+    assert router.call('other', 'initiate_payment', 10) == ('primary', {'transactionId': 1})
+
+
+def test_routing_prefers_healthy_provider_over_fast_failures():
+    router = RoutingFactory({'failing': HelcimFactory(), 'healthy': HelcimFactory()})
+    for call in range(20):
+        router.stats['failing'].record(0.005, call % 100 != 0)
+        router.stats['healthy'].record(0.8, False)
+
+    assert router.metrics()['failing']['latency'] == 0.005
+    assert router.candidates() == ['healthy', 'failing']
+
+
+def test_routing_counts_error_results_as_failures():
+    session = FakeSession(
+        FakeResponse(200, {'status': 'ERROR'}),
+        FakeResponse(200, {'errors': {'cardToken': 'invalid'}}),
+        FakeResponse(200, {'transactionId': 1}),
+    )
+    router = RoutingFactory({'primary': FakePaymentFactory(fake_transport(session))})
+
+    for amount in (10, 20, 30):
+        router.call('merchant', 'initiate_payment', amount)
+
+    metrics = router.metrics()['primary']
+    assert metrics['calls'] == 3
+    assert 0 < metrics['error_rate'] < 1
+    # only the successful call counts towards latency
+    assert metrics['latency'] is not None
+    assert HelcimFactory.is_failed_result(FakeResponse(503))
+    assert HelcimFactory.is_failed_result(FakeResponse(429))
+    assert not HelcimFactory.is_failed_result(FakeResponse(200))
+
+
+def test_server_address_refreshes_in_background():
+    addresses = ['10.0.0.1', '10.0.0.2']
+    release = threading.Event()
+
+    def resolver():
+        if len(addresses) == 1:
+            assert release.wait(1)
+        return addresses.pop(0)
+
+    address = ServerAddress(resolver, refresh_interval=0.05)
+    assert address.get() == '10.0.0.1'
+    assert address.get() == '10.0.0.1'
+
+    time.sleep(0.06)
+    # the stale value is returned while the refresh runs
+    assert address.get() == '10.0.0.1'
+    assert address.refreshing
+    release.set()
+    for _ in range(100):
+        if not address.refreshing:
+            break
+        time.sleep(0.01)
+    assert address.get() == '10.0.0.2'
+    assert addresses == []
+
+
+def test_server_address_keeps_previous_value_on_failure():
+    results = ['10.0.0.1', ConnectionError('no route'), None, '10.0.0.3']
+
+    def resolver():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    address = ServerAddress(resolver, refresh_interval=60)
+    assert address.resolve() == '10.0.0.1'
+    assert address.refresh() == '10.0.0.1'
+    assert address.refresh() == '10.0.0.1'
+    assert address.refresh() == '10.0.0.3'
+
+
+def test_warm_up_leaves_sighup_alone(monkeypatch):
+    installed = []
+    monkeypatch.setattr(helcim_pipeline.server_address, 'resolver', lambda: '10.0.0.1')
+    monkeypatch.setattr(helcim_pipeline.server_address, 'value', None)
+    monkeypatch.setattr(
+        helcim_pipeline.server_address, 'install_signal_handler', lambda: installed.append(True))
+
+    helcim_pipeline.warm_up()
+
+    assert helcim_pipeline.server_address.value == '10.0.0.1'
+    assert installed == []
+
+
+INVOICE_URL = 'https://api.helcim.com/v2/invoices/'
+
+
+def test_paid_invoice_is_cached_under_id_and_number(monkeypatch):
+    helcim_cache.invoice_cache.clear()
+    session = FakeSession(FakeResponse(200, [{'invoiceId': 1, 'invoiceNumber': 'INV1', 'status': 'PAID'}]))
+    fake_pipeline(monkeypatch, fake_transport(session))
+
+    invoice = HelcimPayment.get_invoice_by_invoice_number('account', 'INV1')
+    invoice['status'] = 'changed by the caller'
+
+    assert HelcimPayment.get_invoice_by_invoice_id('account', 1)['status'] == 'PAID'
+    assert HelcimPayment.get_invoice_by_invoice_number('account', 'INV1')['status'] == 'PAID'
+    assert len(session.calls) == 1
+    # invoices of other accounts are separate entries
+    assert helcim_cache.get_cached_invoice('other', 'id', 1) is None
+
+
+def test_open_invoice_is_not_cached_by_default(monkeypatch):
+    helcim_cache.invoice_cache.clear()
+    session = FakeSession(
+        FakeResponse(200, {'invoiceId': 2, 'invoiceNumber': 'INV2', 'status': 'DUE'}),
+        FakeResponse(200, {'invoiceId': 2, 'invoiceNumber': 'INV2', 'status': 'PAID'}),
+    )
+    fake_pipeline(monkeypatch, fake_transport(session))
+
+    assert HelcimPayment.get_invoice_by_invoice_id('account', 2)['status'] == 'DUE'
+    assert HelcimPayment.get_invoice_by_invoice_id('account', 2)['status'] == 'PAID'
+    assert len(session.calls) == 2
+
+    helcim_cache.invoice_cache.clear()
+    monkeypatch.setattr(settings, 'HELCIM_CACHE_OPEN_INVOICES', True, raising=False)
+    helcim_cache.cache_invoice('account', {'invoiceId': 3, 'status': 'DUE'})
+    assert helcim_cache.get_cached_invoice('account', 'id', 3) == {'invoiceId': 3, 'status': 'DUE'}
+
+
+def test_batch_invoice_fetch_uses_cache_and_maps_failures(monkeypatch):
+    helcim_cache.invoice_cache.clear()
+    helcim_cache.cache_invoice('account', {'invoiceId': 1, 'invoiceNumber': 'INV1', 'status': 'PAID'})
+    session = FakeSession(
+        FakeResponse(200, {'invoiceId': 2, 'invoiceNumber': 'INV2', 'status': 'PAID'}),
+        requests.ConnectionError('reset'),
+    )
+    retry_policy = RetryPolicy(max_attempts=1, budget=RetryBudget(ratio=0, burst=0))
+    fake_pipeline(monkeypatch, fake_transport(session), retry_policy)
+
+    invoices = HelcimPayment.get_invoices_by_invoice_id('account', [1, 2, 2, 3], max_workers=1)
+
+    assert list(invoices) == [1, 2, 3]
+    assert invoices[1]['invoiceNumber'] == 'INV1'
+    assert invoices[2]['invoiceNumber'] == 'INV2'
+    assert invoices[3] is None
+    assert [url for _, url, _ in session.calls] == [INVOICE_URL + '2', INVOICE_URL + '3']
+    assert helcim_cache.get_cached_invoice('account', 'number', 'INV2')['invoiceId'] == 2
+
+
+def test_ttl_cache_expires_and_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # b was the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache.set('long', 4, ttl=10)
+    time.sleep(0.06)
+    # expired entries are only dropped when read
+    assert len(cache) == 2
+    assert cache.get('c') is None
+    assert cache.get('long') == 4
+    assert len(cache) == 1
+
+
+CARDS = [
+    {'cardToken': 'token-1', 'cardF6L4': '4111111111', 'cardExpiry': '0128'},
+]
+
+
+def test_customer_cards_are_cached_and_copied(monkeypatch):
+    helcim_cache.customer_cards_cache.clear()
+    session = FakeSession(FakeResponse(200, CARDS))
+    fake_pipeline(monkeypatch, fake_transport(session))
+
+    cards = HelcimClinet.get_customer_cards('account', 'customer')
+    cards[0]['last4'] = 'changed by the caller'
+    cards.append({'funding_id': 'not saved'})
+
+    cached = HelcimClinet.get_customer_cards('account', 'customer')
+    assert cached == [{'funding_id': 'token-1', 'last4': '1111', 'exp_month': '01',
+                       'exp_year': '28', 'brand': None}]
+    assert len(session.calls) == 1
+
+
+def test_payment_with_new_card_drops_cached_cards(monkeypatch):
+    helcim_cache.customer_cards_cache.clear()
+    session = FakeSession(
+        FakeResponse(200, CARDS),
+        FakeResponse(200, {'transactionId': 1, 'status': 'APPROVED'}),
+        FakeResponse(200, {'transactionId': 2, 'status': 'APPROVED'}),
+        FakeResponse(200, CARDS + [{'cardToken': 'token-2', 'cardF6L4': '5454545454', 'cardExpiry': '0229'}]),
+    )
+    fake_pipeline(monkeypatch, fake_transport(session))
+    HelcimClinet.get_customer_cards('account', 'customer')
+
+    # a payment with a saved card keeps the list
+    HelcimPayment.payment('account', 10, 'token-1', customer_id='customer', ipAddress='1.2.3.4')
+    assert HelcimClinet.get_cached_customer_cards('account', 'customer') is not None
+
+    HelcimPayment.payment('account', 10, 'token-2', customer_id='customer', ipAddress='1.2.3.4')
+    assert HelcimClinet.get_cached_customer_cards('account', 'customer') is None
+    cards = HelcimClinet.get_customer_cards('account', 'customer')
+    assert [card['funding_id'] for card in cards] == ['token-1', 'token-2']
+    assert len(session.calls) == 4
+
+
+class FakeManager:
+    """objects manager of a fake model, get() matches field values and counts calls"""
+
+    def __init__(self, *rows):
+        self.rows = rows
+        self.lookups = []
+
+    def get(self, **lookup):
+        self.lookups.append(lookup)
+        for row in self.rows:
+            if all(
+                getattr(row, field.replace('__in', '')) in value if field.endswith('__in')
+                else getattr(row, 'pk' if field == 'id' else field) == value
+                for field, value in lookup.items()
+            ):
+                return row
+        raise LookupError(lookup)
+
+
+class FakeRow:
+    def __init__(self, pk, name):
+        self.pk = pk
+        self.name = name
+
+
+class Client:
+    objects = FakeManager(FakeRow(1, 'acme'), FakeRow(2, 'globex'))
+
+
+def test_identity_map_counts_queries_and_hits():
+    Client.objects.lookups.clear()
+    with identity_map() as imap:
+        first = get_object(Client, name='acme')
+        assert get_object(Client, name='acme') is first
+        # the row is mapped under its pk as well, `id` and `pk` are the same key
+        assert get_object(Client, id=1) is first
+        assert get_object(Client, pk=1) is first
+        assert imap.queries['Client'] == 1 and imap.hits['Client'] == 3
+
+        with identity_map() as nested:
+            assert nested is imap
+            assert get_object(Client, pk=2).name == 'globex'
+        assert imap.queries['Client'] == 2
+
+        # a list can't be hashed into a key, the lookup goes to the database
+        assert get_object(Client, name__in=['acme']) is first
+        assert get_object(Client, name__in=['acme']) is first
+        assert imap.queries['Client'] == 4 and imap.hits['Client'] == 3
+
+    assert get_identity_map() is None
+    get_object(Client, name='acme')
+    assert len(Client.objects.lookups) == 5